@@ -46,9 +46,12 @@ class Peak(object):
         #     b_trace = self.baseline[mz]
 
         if mz in {'', 'x', 'tic', None}:
-            # sum up all the components
-            trace = self.components[0].trace
+            # sum up all the components (into copies, so the operators
+            # below don't change the first component's data)
+            trace = self.components[0].trace.copy()
             b_trace = self.components[0].baseline
+            if b_trace is not None:
+                b_trace = b_trace.copy()
             for c in self.components[1:]:
                 trace += c.trace
                 if c.baseline is not None:
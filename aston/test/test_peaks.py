@@ -27,3 +27,17 @@ class TestGaussianPeak(TestBoxPeak):
         baseline = Trace([0, 9], [0, 0], name=1)
         c = PeakComponent(info, trace, baseline)
         self.peak = Peak('gaussian', components=c)
+
+
+class TestMultiComponentPeak(unittest.TestCase):
+    def test_as_poly_leaves_components(self):
+        t = np.arange(5)
+        cs = [PeakComponent({}, Trace([0, 1, 2, 1, 0], t, name=1),
+                            Trace(np.zeros(5), t, name=1))
+              for _ in range(2)]
+        peak = Peak('double', components=cs)
+        poly = peak.as_poly()
+        assert np.all(peak.as_poly() == poly)
+        for c in cs:
+            assert np.all(c.trace.values == [0, 1, 2, 1, 0])
+            assert np.all(c.baseline.values == 0)
@@ -1,4 +1,11 @@
-from aston.tracefile import TraceFile
+import errno
+import os
+import struct
+import subprocess
+import sys
+import numpy as np
+from aston.tracefile import TraceFile, load_many, set_cache_dir
+from aston.tracefile.mime import tfclasses
 
 DXF_FILE = './test_data/b3_alkanes.dxf'
 MS_FILE = './test_data/carotenoid_extract.d/MSD1.MS'
@@ -25,6 +32,8 @@ def test_agilent_ms():
     assert data.shape == (2534, 4801)
     assert min(data.columns) == 100.1
     assert max(data.columns) == 999.6
+    assert data.values.nnz == 95471
+    assert data.values.sum() == 17657612.0
 
 
 def test_agilent_uv():
@@ -35,3 +44,131 @@ def test_agilent_uv():
     assert data.shape == (6744, 300)
     assert min(data.columns) == 200.0
     assert max(data.columns) == 798.0
+
+
+def test_agilent_ms_scan():
+    df = TraceFile(MS_FILE)
+    scn = df.scan(5.0)
+    row = df.data.scan(5.0)
+    assert sorted(zip(scn.x, scn.abn)) == \
+        sorted((x, a) for x, a in zip(row.x, row.abn) if a != 0)
+    assert df.scan(5.0, 0.5).abn.sum() == \
+        df.data.values[278:307].sum()
+    for agg in ['max', 'mean']:
+        scn = df.scan(5.0, 0.5, aggfunc=agg)
+        row = df.data.scan(5.0, 0.5, aggfunc=agg)
+        assert sorted(zip(scn.x, scn.abn)) == \
+            sorted((x, a) for x, a in zip(row.x, row.abn) if a != 0)
+
+    tic = df.total_trace(twin=(1, 2))
+    assert tic.index[0] >= 1 and tic.index[-1] <= 2
+
+
+def test_load_many():
+    done = []
+    for workers in [1, 2]:
+        res = {fn: (d, e) for fn, d, e in load_many(
+            [DXF_FILE, MS_FILE, './test_data/missing.ms'],
+            what=('info', 'total_trace'), workers=workers,
+            progress=lambda n, tot: done.append((n, tot)))}
+        assert res[DXF_FILE][0]['info']['d13c_std'] == '-43.411'
+        assert len(res[MS_FILE][0]['total_trace']) == 2534
+        assert res['./test_data/missing.ms'][0] is None
+        assert isinstance(res['./test_data/missing.ms'][1], IOError)
+    assert done[-1] == (3, 3)
+
+
+def test_disk_cache(tmpdir):
+    set_cache_dir(str(tmpdir))
+    try:
+        for fn in [MS_FILE, DXF_FILE]:
+            data = TraceFile(fn).data
+            cached = TraceFile(fn).data
+            assert isinstance(cached.values, type(data.values))
+            assert cached.shape == data.shape
+            assert isinstance(cached.columns, type(data.columns))
+            assert np.array_equal(cached.columns, data.columns)
+            assert np.all(cached.index == data.index)
+            assert (abs(cached.values - data.values)).sum() == 0
+        assert len(tmpdir.listdir()) == 2
+    finally:
+        set_cache_dir(None)
+
+
+def test_readers_registry():
+    for mime, cls in tfclasses().items():
+        assert cls.mime == mime
+
+
+def test_lazy_readers():
+    # opening a file should only import the reader it needs
+    code = ('import sys; from aston.tracefile import TraceFile; '
+            'TraceFile("{}").data; '
+            'print(sorted(m for m in sys.modules '
+            'if m.startswith("aston.tracefile.")))').format(DXF_FILE)
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.decode().strip() == "['aston.tracefile.mime', " \
+        "'aston.tracefile.thermo']"
+
+    # and load_many's process pool isn't set up until it's used
+    code = ('import sys, aston.tracefile; '
+            'print("multiprocessing" in sys.modules)')
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.decode().strip() == 'False'
+
+
+def test_disk_cache_deps(tmpdir):
+    # the data in a Waters *.IDX file is really in the *.DAT file
+    idx = struct.pack('<IHHffhhh', 0, 4, 0, 5, 0, 0, 10, 128)
+    tmpdir.join('A.IDX').write_binary(idx)
+    tmpdir.join('A.DAT').write_binary(struct.pack('<HH', 5, 40))
+    # the cache directory doesn't exist yet
+    set_cache_dir(str(tmpdir.join('cache')))
+    try:
+        fn = str(tmpdir.join('A.IDX'))
+        assert TraceFile(fn).data.values.toarray().tolist() == [[5]]
+        tmpdir.join('A.DAT').write_binary(struct.pack('<HH', 6, 40))
+        os.utime(str(tmpdir.join('A.DAT')), (0, 0))
+        assert TraceFile(fn).data.values.toarray().tolist() == [[6]]
+    finally:
+        set_cache_dir(None)
+
+
+def test_disk_cache_damaged(tmpdir):
+    set_cache_dir(str(tmpdir))
+    try:
+        data = TraceFile(DXF_FILE).data
+        entry = tmpdir.listdir()[0]
+        entry.join('values.npy').write_binary(b'\x93NUMPY')
+        cached = TraceFile(DXF_FILE).data
+        assert np.all(cached.values == data.values)
+        # and the entry was rewritten
+        assert np.all(TraceFile(DXF_FILE).data.values == data.values)
+        assert entry.join('values.npy').size() > 100
+    finally:
+        set_cache_dir(None)
+
+
+def test_disk_cache_unusable(tmpdir, monkeypatch):
+    data = TraceFile(DXF_FILE).data
+    # the cache "directory" can't be made, since there's a file there
+    tmpdir.join('file').write('')
+    set_cache_dir(str(tmpdir.join('file', 'cache')))
+    try:
+        assert np.all(TraceFile(DXF_FILE).data.values == data.values)
+    finally:
+        set_cache_dir(None)
+
+    # a good entry that can't be opened right now is left alone
+    set_cache_dir(str(tmpdir.join('cache')))
+    try:
+        TraceFile(DXF_FILE).data
+        entry = tmpdir.join('cache').listdir()[0]
+
+        def no_fds(*args, **kwargs):
+            raise OSError(errno.EMFILE, 'Too many open files')
+        monkeypatch.setattr(np, 'load', no_fds)
+        assert np.all(TraceFile(DXF_FILE).data.values == data.values)
+        assert entry.check(dir=True)
+    finally:
+        set_cache_dir(None)
@@ -0,0 +1,403 @@
+import io
+import struct
+import zlib
+import numpy as np
+from aston.tracefile import c_serialized_records, find_offset, \
+    parse_c_serialized
+from aston.tracefile.agilent_fid import double_delta_decode
+from aston.tracefile.agilent_ms import AgilentMSMSScan
+from aston.tracefile.agilent_uv import AgilentCSDAD, AgilentCSDAD2, \
+    AgilentDAD, delta_decode, read_ch_records
+from aston.tracefile.bruker import BrukerMSMS
+from aston.tracefile.inficon import InficonHapsite
+from aston.tracefile.thermo import ThermoCF
+from aston.tracefile.waters import WatersAutospec
+
+
+def encode_deltas(vals, order='<', every=5):
+    """
+    Delta-compresses a list of ints, forcing an int32
+    escape for every `every`-th value.
+    """
+    out, prev = b'', 0
+    for i, v in enumerate(vals):
+        d = v - prev
+        if -32768 < d < 32768 and i % every != every - 1:
+            out += struct.pack(order + 'h', d)
+        else:
+            out += struct.pack(order + 'hi', -32768, v)
+        prev = v
+    return out
+
+
+def test_delta_decode():
+    # 0x80008000 puts a fake escape inside the int32 after the real one
+    streams = [[0, 5, -3, 200000, 17, -2147450880, 12, 1, 2, 3],
+               [40000, 40001, -40000, 7],
+               []]
+    for order in '<>':
+        raw, starts, ends = b'\x00', [], []
+        for s in streams:
+            starts.append(len(raw))
+            raw += encode_deltas(s, order, every=3)
+            ends.append(len(raw))
+            raw += b'\x80\x00'  # padding that's not part of the stream
+        buf = np.frombuffer(raw, dtype=np.uint8)
+        vals = delta_decode(buf, starts, ends, [len(s) for s in streams],
+                            order=order)
+        assert vals.tolist() == sum(streams, [])
+
+
+def test_ch_records():
+    # the same values split into *.CH style records
+    vals = [3, 4, -2147450880, 5, 1000000, 6, 7, 8, 9, 10, 0, -40000]
+    raw = 4 * b'\x00'
+    prev = 0
+    for rec in [vals[:5], vals[5:6], vals[6:]]:
+        raw += bytes([0x10, len(rec)])
+        for i, v in enumerate(rec):
+            d = v - prev
+            if -32768 < d < 32768 and v != 7:
+                raw += struct.pack('>h', d)
+            else:
+                raw += struct.pack('>hi', -32768, v)
+            prev = v
+    raw += b'\x00\x00\x80\x00'
+    buf = np.frombuffer(raw, dtype=np.uint8)
+    recs = read_ch_records(buf, 4)
+    assert recs[2].tolist() == [5, 1, 6]
+    dvals = delta_decode(buf, *recs, order='>', join=True)
+    assert dvals.tolist() == vals
+
+
+def double_delta_loop(raw):
+    # the original, one-word-at-a-time FID decoder
+    f = io.BytesIO(raw)
+    data = []
+    delt = 0
+    while True:
+        try:
+            inp = struct.unpack('>h', f.read(2))[0]
+        except struct.error:
+            break
+
+        if inp == 32767:
+            inp = struct.unpack('>i', f.read(4))[0]
+            inp2 = struct.unpack('>H', f.read(2))[0]
+            delt = 0
+            data.append(inp * 65534 + inp2)
+        else:
+            delt += inp
+            data.append(data[-1] + delt)
+    return data
+
+
+def test_double_delta_decode():
+    rng = np.random.RandomState(42)
+    raw = b''
+    for _ in range(20):
+        # 0x7FFF inside the int32 / uint16 should not count as escapes
+        a, b = rng.choice([rng.randint(-2 ** 31, 2 ** 31), 0x7FFF7FFF]), \
+            rng.choice([rng.randint(0, 2 ** 16), 0x7FFF])
+        raw += struct.pack('>hiH', 32767, a, b)
+        raw += rng.randint(-300, 300, rng.randint(0, 200)).astype('>i2') \
+            .tobytes()
+    raw += b'\x00'  # partial word at the end
+
+    words = np.frombuffer(raw[:-1], dtype='>i2')
+    assert double_delta_decode(words).tolist() == double_delta_loop(raw)
+
+
+def test_waters_autospec(tmpdir):
+    # three scans with a few (abundance, ion) points each
+    scans = [[(5, 40), (7, 44)], [(2, 28), (9, 44), (1, 45)], [(3, 40)]]
+    idx, dat = b'', b''
+    for i, pts in enumerate(scans):
+        idx += struct.pack('<IHHffhhh', len(dat), 4 * len(pts), 0,
+                           sum(p[0] for p in pts), 0.5 * i, 0, 10, 128)
+        dat += b''.join(struct.pack('<HH', *p) for p in pts)
+    tmpdir.join('A.IDX').write_binary(idx)
+    tmpdir.join('A.DAT').write_binary(dat)
+
+    tf = WatersAutospec(str(tmpdir.join('A.IDX')))
+    tic = tf.total_trace()
+    assert list(tic.index) == [0, 0.5, 1]
+    assert list(tic.values) == [12, 12, 3]
+
+    data = tf.data
+    assert data.columns == [28, 40, 44, 45]
+    assert list(data.index) == [0, 0.5, 1]
+    assert data.values.toarray().tolist() == [[0, 5, 7, 0], [2, 0, 9, 1],
+                                              [0, 3, 0, 0]]
+
+
+def write_hapsite(path, segments, scans):
+    """
+    Writes a minimal Inficon Hapsite file; `segments` is a list of
+    [(ion1, ion2, type)] and `scans` is a list of (time, seg, abns).
+    """
+    out = bytearray(b'\x00' * 64)
+    # segment table: FFFFFFFF, 64 bytes, nsegments, segments
+    out += 4 * b'\xff' + b'\x00' * 64 + struct.pack('<I', len(segments))
+    for seg in segments:
+        out += b'\x00' * 96 + struct.pack('<I', len(seg))
+        for i1, i2, itype in seg:
+            out += struct.pack('<8I', i1, i2, 0, 0, 0, 0, itype, 0)
+    out += b'\x00' * 64
+    out += 4 * b'\xff' + b'HapsSearch' + b'\x00' * 2
+    recs = b''
+    for t, seg, abns in scans:
+        recs += struct.pack('<IiHHHH', 0, t, 0, len(abns), 0, seg)
+        recs += struct.pack('<%df' % len(abns), *abns)
+    out += b'\x00' * 20
+    # the length is measured to the start of the last record
+    last_len = 16 + 4 * len(scans[-1][2])
+    out += struct.pack('<I', len(recs) - last_len + 1) + b'\x00' * 4
+    out += 4 * b'\xff' + b'HapsScan' + b'\x00' * 56 + recs
+    with open(path, 'wb') as f:
+        f.write(bytes(out))
+
+
+def test_inficon_hapsite(tmpdir):
+    # a full scan from 45-47 and a SIM segment that repeats mz 78
+    segs = [[(4500, 4700, 1)], [(7800, 0, 0), (9100, 0, 0), (7800, 0, 0)]]
+    scans = [(0, 1, [1, 2, 3]), (60000, 1, [4, 5, 6]),
+             (120000, 2, [7, 8, 9]), (180000, 3, [1, 1, 1])]
+    write_hapsite(str(tmpdir.join('a.hps')), segs, scans)
+
+    data = InficonHapsite(str(tmpdir.join('a.hps'))).data
+    assert data.columns == [45, 46, 47, 78, 91]
+    # the last scan is in a segment that's not listed, so it's dropped
+    assert list(data.index) == [0, 1, 2]
+    assert data.values.toarray().tolist() == [[1, 2, 3, 0, 0],
+                                              [4, 5, 6, 0, 0],
+                                              [0, 0, 0, 9, 8]]
+
+
+def test_bruker_msms(tmpdir):
+    scans = [(60., [100.25, 200.5], [1, 2]),
+             (120., [100.5, 150.75, 200.5], [3, 4, 5])]
+    d = struct.pack('<ii', 0, len(scans))
+    d += struct.pack('<%dd' % len(scans), *[s[0] for s in scans])
+    d += struct.pack('<i', len(scans))
+    for _, mzs, abns in scans:
+        d += struct.pack('<i%dfi%df' % (len(mzs), len(mzs)),
+                         len(mzs), *(mzs + [len(mzs)] + abns))
+    tmpdir.join('a.ami').write_binary(d)
+    tf = BrukerMSMS(str(tmpdir.join('a.ami')))
+
+    data = tf.data
+    assert list(data.index) == [1, 2]
+    assert list(data.columns) == [100.25, 100.5, 150.75, 200.5]
+    assert data.values.toarray().tolist() == [[1, 0, 0, 2], [0, 3, 4, 5]]
+
+    data = tf.binned_data(tol=0.3)
+    assert list(data.columns) == [100.375, 150.75, 200.5]
+    assert data.values.toarray().tolist() == [[1, 0, 2], [3, 4, 5]]
+
+
+MH_XSD = '''<?xml version="1.0" encoding="utf-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:complexType name="ScanRecordType">
+    <xs:sequence>
+      <xs:element name="ScanID" type="xs:int" />
+      <xs:element name="ScanTime" type="xs:double" />
+      <xs:element name="TIC" type="xs:double" />
+      <xs:element name="BasePeakMZ" type="xs:double" />
+      <xs:element name="MzOfInterest" type="xs:double" />
+      <xs:element name="SpectrumParamValues" type="SpectrumParamsType" />
+    </xs:sequence>
+  </xs:complexType>
+  <xs:complexType name="SpectrumParamsType">
+    <xs:sequence>
+      <xs:element name="SpectrumFormatID" type="xs:byte" />
+      <xs:element name="SpectrumOffset" type="xs:long" />
+      <xs:element name="ByteCount" type="xs:int" />
+      <xs:element name="PointCount" type="xs:int" />
+      <xs:element name="MinX" type="xs:double" />
+      <xs:element name="MaxX" type="xs:double" />
+      <xs:element name="ScanID" type="xs:short" />
+    </xs:sequence>
+  </xs:complexType>
+</xs:schema>
+'''
+MH_REC = '<iddddbqiiddh'
+
+
+def write_msscan(path, recs):
+    """
+    Writes a MassHunter MSScan.bin (and its schema) holding `recs`.
+    """
+    with open(path[:-4] + '.xsd', 'w') as f:
+        f.write(MH_XSD)
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * 0x58 + struct.pack('<i', 0x60) + b'\x00' * 4)
+        for r in recs:
+            f.write(struct.pack(MH_REC, *r))
+
+
+def test_agilent_msms_scan(tmpdir):
+    fname = str(tmpdir.join('MSScan.bin'))
+    write_msscan(fname, [(i, 0.1 * i, 10. * i, [100., 150.][i % 2],
+                          300., 2, 0, 0, 0, 0., 0., -1) for i in range(10)])
+    tf = AgilentMSMSScan(fname)
+    assert tf._scan_table['ScanID'].tolist() == list(range(10))
+
+    tic = tf.total_trace(twin=(0.2, 0.5))
+    assert np.allclose(tic.index, [0.2, 0.3, 0.4, 0.5])
+    assert tic.values.tolist() == [20, 30, 40, 50]
+
+    mrm = tf.mrm_trace(parent=300, daughter=150, twin=(0.2, 0.5))
+    assert mrm.values.tolist() == [30, 50]
+    assert len(tf.mrm_trace(parent=400)) == 0
+
+
+def test_agilent_msms_profile(tmpdir):
+    # one gzip-compressed int spectrum and one uncompressed float one
+    spcs = [(1, list(range(5))), (2, [0.5, 1.5, 2.5])]
+    prof, recs = b'', []
+    for i, (fmt, pts) in enumerate(spcs):
+        d = struct.pack('<dd', 0, 0)
+        d += struct.pack('<%d%s' % (len(pts), 'if'[fmt - 1]), *pts)
+        if fmt == 1:
+            c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+            d = c.compress(d) + c.flush()
+        recs.append((i, float(i), 0., 0., 0., fmt, len(prof), len(d),
+                     len(pts), 100., 200., 0))
+        prof += d
+    tmpdir.join('MSProfile.bin').write_binary(prof)
+    fname = str(tmpdir.join('MSScan.bin'))
+    write_msscan(fname, recs)
+
+    for workers in [1, None]:
+        scans = list(AgilentMSMSScan(fname).scans(workers=workers))
+        assert [s.name for s in scans] == [0, 1]
+        assert scans[0].abn.tolist() == list(range(5))
+        assert scans[0].x.tolist() == [100, 125, 150, 175, 200]
+        assert scans[1].abn.tolist() == [0.5, 1.5, 2.5]
+        assert len(list(AgilentMSMSScan(fname).scans(twin=(0.5, 2)))) == 1
+
+
+def test_agilent_csdad(tmpdir):
+    # two scans over different wavelength ranges (in 1/20ths of a nm)
+    scans = [((4000, 4100, 20), [100, 110, 90, 90, 95]),
+             ((4040, 4100, 40), [-5, 70000])]
+    d = bytearray(0x202)
+    d[0x116:0x11A] = struct.pack('>i', len(scans))
+    d[0x146:0x149] = b'\x02mA'
+    for i, (wvs, vals) in enumerate(scans):
+        # the deltas start from an int16 value (3) instead of zero
+        s = encode_deltas([3] + vals, every=3)
+        d += struct.pack('<HL3H8x', 20 + len(s), 6000 * i, *wvs) + s
+    tmpdir.join('a.uv').write_binary(bytes(d))
+
+    data = AgilentCSDAD(str(tmpdir.join('a.uv'))).data
+    assert data.yunits == 'mA'
+    assert list(data.index) == [0, 0.1]
+    assert list(data.columns) == [200, 201, 202, 203, 204]
+    assert np.allclose(data.values * 2000, [[100, 110, 90, 90, 95],
+                                            [0, 0, -5, 0, 70000]])
+
+
+def write_csdad2(path, scans, yunits='mAU'):
+    """
+    Writes out a newer-style (0331) Chemstation DAD file; each scan
+    is ((start, end, step) wavelengths in 1/20ths of a nm, values).
+    """
+    d = bytearray(0x1002)
+    d[0x116:0x11A] = struct.pack('>i', len(scans))
+    d[0xC15:0xC16 + 2 * len(yunits)] = struct.pack('>B', len(yunits)) + \
+        yunits.encode('utf_16_le')
+    for i, (wvs, vals) in enumerate(scans):
+        # unlike 0233 files, the deltas just start from zero
+        s = encode_deltas(vals, every=3)
+        d += struct.pack('<HL3H8x', 20 + len(s), 6000 * i, *wvs) + s
+    with open(path, 'wb') as f:
+        f.write(bytes(d))
+
+
+def test_agilent_csdad2(tmpdir):
+    write_csdad2(str(tmpdir.join('a.uv')),
+                 [((4000, 4100, 20), [100, 110, 90, 90, 95]),
+                  ((4040, 4100, 40), [-5, 70000]),
+                  ((4000, 4060, 20), [1, 2, 3])])
+
+    data = AgilentCSDAD2(str(tmpdir.join('a.uv'))).data
+    assert data.yunits == 'mAU'
+    assert list(data.index) == [0, 0.1, 0.2]
+    assert list(data.columns) == [200, 201, 202, 203, 204]
+    assert np.allclose(data.values * 2000, [[100, 110, 90, 90, 95],
+                                            [0, 0, -5, 0, 70000],
+                                            [1, 2, 3, 0, 0]])
+
+
+def write_mh_dad(path, scans, gap=24):
+    """
+    Writes a MassHunter DAD1.sd/.sp pair; `scans` is a list of
+    (time, first wavelength, wavelength step, absorbances).
+    """
+    sd = [bytes(0x50), struct.pack('<Q', len(scans)), bytes(0xA4 - 0x58)]
+    sp, off = [], 0
+    for t, srt, stp, vals in scans:
+        sd.append(struct.pack('<IdddIQIIdddd', 0, t, 0, stp, 0, off, 0,
+                              len(vals), srt, 0, 0, 0))
+        rec = bytes(16) + np.asarray(vals, '<f8').tobytes() + bytes(gap)
+        sp.append(rec)
+        off += len(rec)
+    with open(path[:-3] + '.sd', 'wb') as f:
+        f.write(b''.join(sd))
+    with open(path[:-3] + '.sp', 'wb') as f:
+        f.write(b''.join(sp))
+
+
+def test_agilent_dad(tmpdir):
+    fname = str(tmpdir.join('DAD1.sd'))
+    write_mh_dad(fname, [(0.1, 200., 2., [1, 2, 3]),
+                         (0.2, 200., 2., [4, 5, 6])])
+    data = AgilentDAD(fname).data
+    assert data.columns == [200, 202, 204]
+    assert list(data.index) == [0.1, 0.2]
+    assert data.values.tolist() == [[1, 2, 3], [4, 5, 6]]
+
+    # the wavelengths change partway through the run
+    write_mh_dad(fname, [(0.1, 200., 2., [1, 2, 3]),
+                         (0.2, 202., 2., [4, 5])])
+    data = AgilentDAD(fname).data
+    assert data.columns == [200, 202, 204]
+    assert data.values.tolist() == [[1, 2, 3], [0, 4, 5]]
+
+
+def test_thermo_cf(tmpdir):
+    d = b'\x00' * 50 + b'CRawDataScanStorage' + b'\x00' * 62
+    d += struct.pack('<H', 2) + b'\x00' * 35
+    d += struct.pack('<fddd', 60., 1., 2., 3.)
+    d += struct.pack('<fddd', 120., 4., 5., 6.) + b'\x00' * 10
+    tmpdir.join('a.cf').write_binary(d)
+    data = ThermoCF(str(tmpdir.join('a.cf'))).data
+    assert data.columns == [44, 45, 46]
+    assert list(data.index) == [1, 2]
+    assert data.values.tolist() == [[1, 2, 3], [4, 5, 6]]
+
+    tmpdir.join('b.cf').write_binary(b'\x00' * 100)
+    assert ThermoCF(str(tmpdir.join('b.cf'))).data is None
+    # empty or cut off files
+    tmpdir.join('c.cf').write_binary(b'')
+    assert ThermoCF(str(tmpdir.join('c.cf'))).data is None
+    tmpdir.join('d.cf').write_binary(d[:100])
+    assert ThermoCF(str(tmpdir.join('d.cf'))).data is None
+
+
+def test_c_serialized():
+    def hdr(name):
+        return b'\xff\xff' + struct.pack('<HH', 1, len(name)) + name
+
+    # a \xff\xff that isn't a marker and a marker that isn't a class
+    d = b'junk' + hdr(b'CFirst') + b'abc\xff\xff' + hdr(b'Xnot') + \
+        hdr(b'CSecond') + b'defg'
+    recs = list(c_serialized_records(io.BytesIO(d)))
+    assert [r[0] for r in recs] == [b'CFirst', b'CSecond']
+    assert recs[0][1] == 4 + 12
+    assert list(parse_c_serialized(io.BytesIO(d))) == [
+        (b'CFirst', b'abc\xff\xff' + hdr(b'Xnot')), (b'CSecond', b'defg')]
+    assert find_offset(io.BytesIO(d), b'CSecond') == len(d) - 4
+    assert find_offset(io.BytesIO(d), b'CFirst', hint=20) is None
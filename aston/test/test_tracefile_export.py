@@ -1,8 +1,9 @@
 # from io import StringIO
 import os
 import numpy as np
+from scipy.io.netcdf import NetCDFFile
 from aston.trace.trace import Chromatogram
-from aston.tracefile.netcdf import write_netcdf
+from aston.tracefile.netcdf import NetCDF, write_netcdf
 
 
 def test_write_netcdf():
@@ -14,3 +15,29 @@ def test_write_netcdf():
     write_netcdf('test.cdf', df)
     # clean up
     os.remove('test.cdf')
+
+
+def test_read_netcdf():
+    f = NetCDFFile('test.cdf', 'w')
+    f.createDimension('scan_number', 3)
+    f.createDimension('point_number', 5)
+    v = f.createVariable('scan_acquisition_time', 'd', ('scan_number',))
+    v[:] = [60., 120., 180.]
+    v = f.createVariable('total_intensity', 'd', ('scan_number',))
+    v[:] = [3., 5., 7.]
+    v = f.createVariable('point_count', 'i', ('scan_number',))
+    v[:] = [2, 1, 2]
+    v = f.createVariable('mass_values', 'f', ('point_number',))
+    v[:] = [44., 45., 46., 44., 46.]
+    v = f.createVariable('intensity_values', 'f', ('point_number',))
+    v[:] = [1., 2., 5., 3., 4.]
+    f.close()
+
+    df = NetCDF('test.cdf')
+    assert np.all(df.total_trace().values == [3., 5., 7.])
+    assert np.all(df.total_trace(twin=(1.9, 3)).index == [2., 3.])
+    data = df.data
+    assert list(data.columns) == [44., 45., 46.]
+    assert np.all(data.index == [1., 2., 3.])
+    assert np.all(data.values.toarray() == [[1, 2, 0], [0, 0, 5], [3, 0, 4]])
+    os.remove('test.cdf')
@@ -0,0 +1,151 @@
+import base64
+import os
+import zlib
+import numpy as np
+from aston.tracefile.mzml import MzML, MzXML
+
+MZML_FILE = 'test.mzml'
+
+
+def cv(acc):
+    return '<cvParam cvRef="MS" accession="' + acc + '" name="" value=""/>'
+
+
+def bin_array(arr, accs):
+    d = base64.b64encode(zlib.compress(arr.astype('<f8').tobytes()))
+    return '<binaryDataArray encodedLength="' + str(len(d)) + '">' + \
+        ''.join(accs) + '<binary>' + d.decode('ascii') + '</binary>' + \
+        '</binaryDataArray>'
+
+
+def write_mzml(filename, nscans=5, indexed=True):
+    """
+    Writes out a small (indexed)mzML file with a TIC chromatogram and
+    spectra whose mz arrays are described in a referenceableParamGroup.
+    """
+    head = '<?xml version="1.0" encoding="utf-8"?>\n' + \
+        '<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">' + \
+        '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">' + \
+        '<referenceableParamGroupList count="1">' + \
+        '<referenceableParamGroup id="mzs">' + cv('MS:1000514') + \
+        cv('MS:1000523') + cv('MS:1000574') + \
+        '</referenceableParamGroup></referenceableParamGroupList>' + \
+        '<run id="R1"><spectrumList count="' + str(nscans) + '">'
+    out = head.encode('utf-8')
+    offsets = []
+    for i in range(nscans):
+        offsets.append(('scan=' + str(i + 1), len(out)))
+        s = '<spectrum index="' + str(i) + '" id="scan=' + str(i + 1) + \
+            '" defaultArrayLength="3"><scanList count="1"><scan>' + \
+            '<cvParam cvRef="MS" accession="MS:1000016" name="" ' + \
+            'value="' + str(0.5 * i) + '"/></scan></scanList>' + \
+            '<binaryDataArrayList count="2">' + \
+            bin_array(np.array([50., 51., 52.]) + i,
+                      ['<referenceableParamGroupRef ref="mzs"/>']) + \
+            bin_array(np.array([1., 2., 3.]) * i,
+                      [cv('MS:1000515'), cv('MS:1000523'),
+                       cv('MS:1000574')]) + \
+            '</binaryDataArrayList></spectrum>'
+        out += s.encode('utf-8')
+    out += b'</spectrumList><chromatogramList count="1">'
+    chrom_off = len(out)
+    c = '<chromatogram index="0" id="TIC" defaultArrayLength="' + \
+        str(nscans) + '">' + cv('MS:1000235') + \
+        '<binaryDataArrayList count="2">' + \
+        bin_array(0.5 * np.arange(nscans),
+                  [cv('MS:1000595'), cv('MS:1000523'), cv('MS:1000574')]) + \
+        bin_array(6. * np.arange(nscans),
+                  [cv('MS:1000515'), cv('MS:1000523'), cv('MS:1000574')]) + \
+        '</binaryDataArrayList></chromatogram>'
+    out += c.encode('utf-8') + b'</chromatogramList></run></mzML>'
+    if indexed:
+        idx_off = len(out)
+        out += b'<indexList count="2"><index name="spectrum">'
+        for sid, off in offsets:
+            out += ('<offset idRef="' + sid + '">' + str(off) +
+                    '</offset>').encode('utf-8')
+        out += b'</index><index name="chromatogram">'
+        out += ('<offset idRef="TIC">' + str(chrom_off) + '</offset>') \
+            .encode('utf-8')
+        out += b'</index></indexList>'
+        out += ('<indexListOffset>' + str(idx_off) + '</indexListOffset>') \
+            .encode('utf-8')
+    out += b'</indexedmzML>'
+    with open(filename, 'wb') as f:
+        f.write(out)
+
+
+def test_mzml_scans():
+    for indexed in [True, False]:
+        write_mzml(MZML_FILE, indexed=indexed)
+        df = MzML(MZML_FILE)
+        scans = list(df.scans())
+        assert len(scans) == 5
+        assert np.all(scans[2].x == [52., 53., 54.])
+        assert np.all(scans[2].abn == [2., 4., 6.])
+        assert [s.name for s in df.scans(twin=(0.4, 1.6))] == [0.5, 1., 1.5]
+
+        s = df.spectrum(3)
+        assert s.name == 1.5 and np.all(s.x == [53., 54., 55.])
+        assert df.spectrum('scan=2').name == 0.5
+        assert df.spectrum('scan=99') is None
+        assert df.spectrum(5) is None
+
+        if indexed:
+            # an end tag split over two reads is still found
+            for chunk_size in range(10, 30):
+                with open(MZML_FILE, 'rb') as f:
+                    f.seek(df._index['spectrum'][1][3])
+                    elem = df._read_elem(f, 'spectrum', chunk_size)
+                assert elem.get('id') == 'scan=4'
+
+        tic = df.total_trace()
+        assert np.all(tic.values == [0., 6., 12., 18., 24.])
+        os.remove(MZML_FILE)
+
+
+def write_mzxml(filename):
+    """
+    Writes out a small mzXML file with an MS2 scan nested in each MS1 scan.
+    """
+    def peaks(mz, abn, compress):
+        d = np.vstack([mz, abn]).T.astype('>f4').tobytes()
+        if compress:
+            d = zlib.compress(d)
+        return '<peaks precision="32" byteOrder="network" ' + \
+            'pairOrder="m/z-int"' + \
+            (' compressionType="zlib"' if compress else '') + '>' + \
+            base64.b64encode(d).decode('ascii') + '</peaks>'
+
+    out = '<?xml version="1.0" encoding="ISO-8859-1"?>\n' + \
+        '<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision/' + \
+        'mzXML_3.2"><msRun scanCount="6">'
+    for i in range(3):
+        out += '<scan num="' + str(2 * i + 1) + '" msLevel="1" ' + \
+            'retentionTime="PT' + str(30 * i) + 'S"' + \
+            ('' if i == 1 else ' totIonCurrent="' + str(10 * i) + '"') + \
+            '>' + peaks([50., 51. + i], [1., 2. * i], i % 2) + \
+            '<scan num="' + str(2 * i + 2) + '" msLevel="2" ' + \
+            'retentionTime="PT' + str(30 * i + 1) + 'S">' + \
+            peaks([30.], [5.], False) + '</scan></scan>'
+    out += '</msRun></mzXML>'
+    with open(filename, 'w') as f:
+        f.write(out)
+
+
+def test_mzxml():
+    write_mzxml(MZML_FILE)
+    df = MzXML(MZML_FILE)
+    assert len(list(df.scans())) == 6
+    scn = list(df.scans(twin=(0.4, 0.6)))[0]
+    assert scn.name == 0.5
+    assert np.all(scn.x == [50., 52.]) and np.all(scn.abn == [1., 2.])
+
+    tic = df.total_trace()
+    assert np.all(tic.values == [0., 5., 3., 5., 20., 5.])
+
+    data = df.data
+    assert data.shape == (3, 4)
+    assert np.all(data.index == [0., 0.5, 1.])
+    assert data.values[2].toarray().tolist() == [[1., 0., 0., 4.]]
+    os.remove(MZML_FILE)
@@ -1,6 +1,8 @@
 import numpy as np
 import base64
-from aston.trace import Trace, decompress
+import pytest
+import scipy.sparse
+from aston.trace import Chromatogram, Trace, decompress
 
 
 # TODO: reenable Trace merging someday, but with more intelligence?
@@ -20,6 +22,107 @@ def test_add():
     assert np.all(np.equal(c.index, np.array([1, 2, 3, 4, 5])))
 
 
+def test_math():
+    t = np.array([1, 2, 3, 4, 5])
+    a = Trace(np.array([10, 20, 30, 40, 50]), t, name='X')
+    b = Trace(np.array([2., 4., 6., 8.]), np.array([1.5, 2.5, 3.5, 4.5]))
+    assert np.all((2 * a - a / 10).values == [19, 38, 57, 76, 95])
+    assert np.all((1 - a).values == [-9, -19, -29, -39, -49])
+    # the other trace is interpolated onto a's times
+    assert np.all((a + b).values == [10, 23, 35, 47, 50])
+    assert np.sum(a) == 150
+    assert np.sqrt(a).name == 'X'
+
+
+def test_math_inplace():
+    t = np.array([1, 2, 3, 4, 5])
+    a = Trace(np.array([10, 20, 30, 40, 50]), t, name='X')
+    c = a
+    c += a
+    assert c is a
+    assert np.all(a.values == [20, 40, 60, 80, 100])
+    # ints that become floats still stay in the same Trace
+    c /= 8
+    assert c is a
+    assert np.all(a.values == [2.5, 5, 7.5, 10, 12.5])
+    # read-only values are swapped out too
+    a.values.flags.writeable = False
+    a += 1
+    assert np.all(a.values == [3.5, 6, 8.5, 11, 13.5])
+    # operands that don't match give the same error as without +=
+    for other in [np.ones(3), np.ones((2, 5))]:
+        with pytest.raises(ValueError) as err:
+            a += other
+        assert 'could not be broadcast' in str(err.value)
+    assert np.all(a.values == [3.5, 6, 8.5, 11, 13.5])
+
+
+def test_twin():
+    a = Trace(np.arange(10), np.array([0, 1, 2, 2, 3, 4, 5, 6, 7, 8.]))
+    assert np.all(a.twin((1.9, 4.4)).values == [2, 3, 4, 5])
+    assert np.all(a.twin((None, 0.5)).values == [0])
+    assert len(a.twin((-1, 20))) == 10
+    # times that aren't in order are still handled
+    b = Trace(np.arange(4), np.array([3, 1, 2, 0.]))
+    assert np.all(b.twin((2.9, 2)).values == [0, 1, 2])
+
+
+def test_chromatogram_trace_twin():
+    c = Chromatogram(np.arange(12.).reshape(6, 2), np.arange(6.), [1, 2])
+    tic = c.trace('tic', twin=(1, 3))
+    assert np.all(tic.index == [1, 2, 3])
+    assert np.all(tic.values == [5, 9, 13])
+
+
+def test_traces_for():
+    v = np.arange(12.).reshape(3, 4)
+    for vals in [v, scipy.sparse.csr_matrix(v)]:
+        c = Chromatogram(vals, np.arange(3.), [71, 57, 'x', 57.3])
+        xics = c.traces_for([57, 71, 85], tol=0.5)
+        assert xics.columns == [57, 71, 85]
+        assert np.all(xics.values[:, 0] == [4, 12, 20])
+        assert np.all(xics.values[:, 1] == [0, 4, 8])
+        assert np.all(np.isnan(xics.values[:, 2]))
+        assert np.all(c.trace('57').values == [4, 12, 20])
+
+
+def test_sparse_chromatogram():
+    v = np.array([[0, 1, 0], [2, 0, 0], [0, 0, 3], [4, 5, 0.]])
+    c = Chromatogram(scipy.sparse.coo_matrix(v), np.arange(4.), [50, 51, 52])
+    assert scipy.sparse.isspmatrix_csr(c.values)
+    assert scipy.sparse.issparse(c[1:3].values)
+    assert scipy.sparse.issparse(c[:, [0, 2]].values)
+    assert c[:, [0, 2]].columns == [50, 52]
+    assert scipy.sparse.issparse(c.copy().values)
+    assert np.all(c[:, 1].values == [1, 0, 0, 5])
+    assert c[3, 1] == 5
+    assert np.all(c.traces[0].values == [0, 2, 0, 4])
+    assert np.all(c.trace().values == [1, 2, 3, 9])
+    assert np.all(c.scan(1, 2).abn == [6, 5, 3])
+    d = decompress(c.compress())
+    assert scipy.sparse.issparse(d.values)
+    assert np.all(d.values.toarray() == v)
+    assert d.columns == [50, 51, 52]
+
+
+def test_scans():
+    v = np.array([[0, 1, 0], [2, 0, 0], [0, 0, 3], [4, 5, 0.]])
+    for vals in [v, scipy.sparse.csr_matrix(v)]:
+        c = Chromatogram(vals, np.arange(4.), [50, 51, 52])
+        scans = list(c.scans())
+        assert [s.name for s in scans] == [0, 1, 2, 3]
+        for s, row in zip(scans, v):
+            assert sorted(zip(s.x, s.abn)) == \
+                [(x, a) for x, a in zip(c.columns, row) if a != 0 or
+                 not scipy.sparse.issparse(vals)]
+        assert [s.name for s in c.scans(twin=(1, 2))] == [1, 2]
+        assert np.all(c.scan_range(0, 2).abn == [2, 1, 3])
+        assert c.scan_range(1.2, 3).name == 1
+        assert c.scan(2.9, -1).name == 2
+        assert np.all(c.scan_range(3, 1, agg='max').abn == [4, 5, 3])
+        assert np.allclose(c.scan_range(1, 3, agg='mean').abn, [2, 5 / 3, 1])
+
+
 def test_compress():
     a = Trace(np.array([10, 20, 30, 40, 50]),
               np.array([1, 2, 3, 4, 5]), name='X')
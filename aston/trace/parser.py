@@ -287,6 +287,10 @@ def parse_ion_string(istr, analyses, twin=None):
         if len(tokenize(istr, token)) != 1:
             ts = tokenize(istr, token)
             s = parse_ion_string(ts[0], analyses, twin)
+            if isinstance(s, Trace):
+                # the operators below work in place, so don't
+                # change a Trace that something else might have
+                s = s.copy()
             for t in ts[1:]:
                 if token == '/':
                     s /= parse_ion_string(t, analyses, twin)
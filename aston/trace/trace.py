@@ -92,74 +92,131 @@ class Trace(object):
                             bounds_error=False, fill_value=fill)(new_times)
         return np.apply_along_axis(f, 0, self.values)
 
-    def _apply_data(self, f, ts, reverse=False):
+    def __array__(self, dtype=None):
+        return np.asarray(self.values, dtype=dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
         """
-        Convenience function for all of the math stuff.
+        Runs numpy ufuncs (and so all of the math operators) directly
+        on the values; any other Traces are lined up with this one's
+        times first. Passing a Trace as `out` updates it in place.
         """
-        # TODO: needs to catch np numeric types?
-        if isinstance(ts, (int, float)):
-            d = ts * np.ones(self.shape[0])
-        elif ts is None:
-            d = None
-        elif np.array_equal(ts.index, self.index):
-            d = ts.values
-        else:
-            d = ts._retime(self.index)
-
-        if not reverse:
-            new_data = np.apply_along_axis(f, 0, self.values, d)
-        else:
-            new_data = np.apply_along_axis(f, 0, d, self.values)
-        return Trace(new_data, self.index, name=self.name)
+        out = kwargs.pop('out', ())
+        if not all(isinstance(o, Trace) for o in out):
+            return NotImplemented
+        if method != '__call__':
+            # reductions (e.g. np.sum) give back plain numbers/arrays
+            if out:
+                return NotImplemented
+            args = [x.values if isinstance(x, Trace) else x for x in inputs]
+            return getattr(ufunc, method)(*args, **kwargs)
+        if ufunc.nout != 1:
+            return NotImplemented
+        # the Trace being written into sets the times, otherwise
+        # the first Trace in the arguments does
+        ref = out[0] if out else self
+
+        args = []
+        for x in inputs:
+            if isinstance(x, Trace):
+                x = ref._align(x)
+            elif not isinstance(x, (int, float, complex, np.number,
+                                    np.ndarray)):
+                return NotImplemented
+            args.append(x)
+        # 1d Traces go along the first axis of 2d ones
+        if any(isinstance(x, Trace) and np.ndim(a) > 1
+               for x, a in zip(inputs, args)):
+            args = [a[:, None] if isinstance(x, Trace) and np.ndim(a) == 1
+                    else a for x, a in zip(inputs, args)]
+
+        if out:
+            try:
+                ufunc(*args, out=ref.values, **kwargs)
+            except (TypeError, ValueError):
+                # the result doesn't fit in the current values (e.g.
+                # ints / 2, or they're read-only) so we have to swap
+                # them out; this raises the same error as the operator
+                # does without `out` if the operands don't match
+                res = ufunc(*args, **kwargs)
+                if np.shape(res) != ref.values.shape:
+                    raise ValueError(
+                        'operands could not be broadcast together with '
+                        'shapes ' + ' '.join(str(np.shape(a)) for a in args))
+                ref.values = res
+            return ref
+        return Trace(ufunc(*args, **kwargs), ref.index, name=ref.name)
+
+    def _align(self, ts):
+        """
+        The values of another Trace at this Trace's times.
+        """
+        if np.array_equal(ts.index, self.index):
+            return ts.values
+        return ts._retime(self.index)
 
     def __add__(self, ts):
-        return self._apply_data(lambda x, y: x + y, ts)
+        return np.add(self, ts)
 
     def __sub__(self, ts):
-        return self._apply_data(lambda x, y: x - y, ts)
+        return np.subtract(self, ts)
 
     def __mul__(self, ts):
-        return self._apply_data(lambda x, y: x * y, ts)
+        return np.multiply(self, ts)
 
     def __div__(self, ts):
-        return self._apply_data(lambda x, y: x / y, ts)
+        return np.true_divide(self, ts)
 
     def __truediv__(self, ts):
-        return self.__div__(ts)
+        return np.true_divide(self, ts)
+
+    def __pow__(self, ts):
+        return np.power(self, ts)
 
     def __reversed(self):
         raise NotImplementedError
 
-    # TODO: this should happen in place?
     def __iadd__(self, ts):
-        return self._apply_data(lambda x, y: x + y, ts)
+        return np.add(self, ts, out=(self,))
 
     def __isub__(self, ts):
-        return self._apply_data(lambda x, y: x - y, ts)
+        return np.subtract(self, ts, out=(self,))
 
     def __imul__(self, ts):
-        return self._apply_data(lambda x, y: x * y, ts)
+        return np.multiply(self, ts, out=(self,))
 
     def __idiv__(self, ts):
-        return self._apply_data(lambda x, y: x / y, ts)
+        return np.true_divide(self, ts, out=(self,))
+
+    def __itruediv__(self, ts):
+        return np.true_divide(self, ts, out=(self,))
+
+    def __ipow__(self, ts):
+        return np.power(self, ts, out=(self,))
 
     def __radd__(self, ts):
-        return self._apply_data(lambda x, y: x + y, ts, reverse=True)
+        return np.add(ts, self)
 
     def __rsub__(self, ts):
-        return self._apply_data(lambda x, y: x - y, ts, reverse=True)
+        return np.subtract(ts, self)
 
     def __rmul__(self, ts):
-        return self._apply_data(lambda x, y: x * y, ts, reverse=True)
+        return np.multiply(ts, self)
 
     def __rdiv__(self, ts):
-        return self._apply_data(lambda x, y: x / y, ts, reverse=True)
+        return np.true_divide(ts, self)
+
+    def __rtruediv__(self, ts):
+        return np.true_divide(ts, self)
+
+    def __rpow__(self, ts):
+        return np.power(ts, self)
 
     def __neg__(self):
-        return self._apply_data(lambda x, y: -x, None)
+        return np.negative(self)
 
     def __abs__(self):
-        return self._apply_data(lambda x, y: abs(x), None)
+        return np.absolute(self)
 
     def compress(self):
         i = self.index.astype(np.float32).tostring()
@@ -186,9 +243,12 @@ class Chromatogram(object):
         #     self.index = data.index.values
         #     self.columns = data.columns.values
         elif index is not None:
-            # TODO: handle sparse arrays
             if isinstance(data, list):
                 self.values = np.array(data)
+            elif scipy.sparse.issparse(data):
+                # sparse data is kept row-wise, so scans are quick to
+                # pull out; see _csc for the column-wise copy
+                self.values = data.tocsr()
             else:
                 self.values = data
             self.index = np.array(index)
@@ -203,7 +263,9 @@ class Chromatogram(object):
 
     def copy(self):
         return Chromatogram(self.values.copy(), self.index.copy(),
-                            self.columns.copy())
+                            list(self.columns) if isinstance(self.columns,
+                                                             list)
+                            else self.columns.copy(), self.yunits)
 
     def __len__(self):
         return self.index.shape[0]
@@ -212,24 +274,41 @@ class Chromatogram(object):
         if isinstance(key, tuple):
             # indexing on multiple dimensions
             # TODO: check that dimensions are in right order
-            v = self.values[key]
-            i = self.index[key[0]]
-            c = self.columns[key[1]]
+            rkey, ckey = key
         else:
             if isinstance(key, np.ndarray):
                 if len(key.shape) > 1:
                     # indexing with a boolean mask
                     raise NotImplementedError
-            v, i = self.values[key], self.index[key]
-            c = self.columns
+            rkey, ckey = key, slice(None)
+        # single rows/columns are taken as slices so everything
+        # below stays 2d (and sparse if it started that way)
+        if isinstance(rkey, (int, np.integer)):
+            rkey = slice(rkey, rkey + 1 or None)
+        if isinstance(ckey, (int, np.integer)):
+            ckey = slice(ckey, ckey + 1 or None)
+
+        if isinstance(ckey, slice) and ckey == slice(None):
+            v, c = self.values, self.columns
+        else:
+            if scipy.sparse.issparse(self.values):
+                v = self._csc()[:, ckey].tocsr()
+            else:
+                v = self.values[:, ckey]
+            c = np.asarray(self.columns, dtype=object)[ckey].tolist()
+            if not isinstance(self.columns, list):
+                c = np.asarray(self.columns)[ckey]
+        v, i = v[rkey], self.index[rkey]
 
         if len(c) == 1:
+            if scipy.sparse.issparse(v):
+                v = v.toarray()
             if len(i) == 1:
                 return v[0, 0]
             else:
-                return Trace(v, i, name=c[0])
+                return Trace(v[:, 0], i, name=c[0])
         else:
-            return Chromatogram(v, i, c)
+            return Chromatogram(v, i, c, self.yunits)
 
     @property
     def traces(self):
@@ -240,40 +319,119 @@ class Chromatogram(object):
         -------
         list
         """
-        traces = []
-        for v, c in zip(self.values.T, self.columns):
-            traces.append(Trace(v, self.index, name=c))
-        return traces
+        return [Trace(self._column(j), self.index, name=c)
+                for j, c in enumerate(self.columns)]
+
+    def _column(self, j):
+        """
+        The (dense) values in the jth column.
+        """
+        if not scipy.sparse.issparse(self.values):
+            return self.values[:, j]
+        csc = self._csc()
+        col = np.zeros(self.shape[0], dtype=csc.dtype)
+        st, en = csc.indptr[j], csc.indptr[j + 1]
+        col[csc.indices[st:en]] = csc.data[st:en]
+        return col
+
+    def _csc(self):
+        """
+        A column-wise (CSC) copy of sparse values, for pulling out
+        whole columns; built the first time it's needed and then kept
+        until the values are replaced.
+        """
+        csc = getattr(self, '_csc_vals', None)
+        if csc is None or csc[0] is not self.values:
+            csc = self._csc_vals = (self.values, self.values.tocsc())
+        return csc[1]
 
     def trace(self, name='tic', tol=0.5, twin=None):
         # TODO: aggfunc in here for tic and numeric
         st_idx, en_idx = _slice_idxs(self, twin)
+        index = self.index[st_idx:en_idx]
 
         if isinstance(name, (int, float, np.float32, np.float64)):
             name = str(name)
 
         if name in ['tic', 'x', '']:
-            data = self.values.sum(axis=1)
+            # only the rows in the time window need to be summed up
+            data = self.values[st_idx:en_idx].sum(axis=1)
+            if scipy.sparse.issparse(self.values):
+                data = np.asarray(data).ravel()
             name = 'tic'
         elif name == '!':
-            data = self[:, 0]
+            data = self._column(0)[st_idx:en_idx]
             name = self.columns[0]
         elif set(name).issubset('1234567890.'):
-            cols = np.genfromtxt(np.array(self.columns).astype(bytes))
-            cols = np.abs(cols - float(name)) < tol
-            if not np.any(cols):
-                data = np.zeros(self.shape[0]) * np.nan
-            elif isinstance(self.values, scipy.sparse.spmatrix):
-                data = self.values[:, cols].toarray().sum(axis=1)
-            else:
-                data = self.values[:, cols].sum(axis=1)
+            data = self.traces_for([float(name)], tol, twin).values[:, 0]
         else:
-            data = np.zeros(self.shape[0]) * np.nan
+            data = np.zeros(len(index)) * np.nan
             name = ''
 
         # TODO: better way to coerce this into the right class?
-        # TODO: use twin
-        return Trace(data, index=self.index, name=name)
+        return Trace(data, index=index, name=name)
+
+    def traces_for(self, names, tol=0.5, twin=None):
+        """
+        Extracts the traces for many numeric columns (e.g. ions) at once.
+
+        Parameters
+        ----------
+        names : list of float
+            The m/z (or wavelength, etc.) of each trace.
+        tol : float, optional
+            Every column within this distance of a name is summed
+            into its trace.
+        twin : tuple, optional
+            Only extract the traces between these two times.
+
+        Returns
+        -------
+        Chromatogram
+            One column for each name; the columns are all NaN for names
+            that didn't match anything.
+        """
+        st_idx, en_idx = _slice_idxs(self, twin)
+        index = self.index[st_idx:en_idx]
+
+        _, order, srt = self._column_index()
+        mzs = np.asarray(names, dtype=float)
+        lo = np.searchsorted(srt, mzs - tol, side='right')
+        cnt = np.maximum(np.searchsorted(srt, mzs + tol, side='left') - lo, 0)
+
+        # which data columns go into which traces; the columns are only
+        # pulled out once even if they're in more than one trace
+        trc = np.repeat(np.arange(len(mzs)), cnt)
+        pos = np.arange(cnt.sum()) + np.repeat(lo - np.cumsum(cnt) + cnt, cnt)
+        used, rows = np.unique(order[pos], return_inverse=True)
+        sel = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, trc)),
+                                      shape=(len(used), len(mzs)))
+        if scipy.sparse.issparse(self.values):
+            # only the needed columns are pulled out of the CSC copy
+            sub = self._csc()[:, used][st_idx:en_idx]
+            data = sub.dot(sel).toarray()
+        else:
+            sub = self.values[st_idx:en_idx, used]
+            data = sel.T.dot(sub.T).T
+        data[:, cnt == 0] = np.nan
+        return Chromatogram(data, index, list(names))
+
+    def _column_index(self):
+        """
+        The columns as floats (NaN where they aren't numbers), along
+        with the order that sorts them and the sorted values.
+
+        This is cached until the columns are replaced.
+        """
+        col_idx = getattr(self, '_col_idx', None)
+        if col_idx is None or col_idx[0] is not self.columns:
+            try:
+                mzs = np.asarray(self.columns, dtype=float)
+            except (TypeError, ValueError):
+                mzs = np.array([_to_float(c) for c in self.columns])
+            order = np.argsort(mzs, kind='mergesort')
+            col_idx = self._col_idx = (self.columns, mzs, order, mzs[order])
+        return col_idx[1:]
 
     def plot(self, style='heatmap', legend=False, cmap=None, ax=None):
         """
@@ -293,11 +451,14 @@ class Chromatogram(object):
             ax = plt.gca()
 
         if style == 'heatmap':
-            ions = self.columns
-            ext = (self.index[0], self.index[-1], min(ions), max(ions))
-            grid = self.values[:, np.argsort(self.columns)].transpose()
-            if isinstance(self.values, scipy.sparse.spmatrix):
-                grid = grid.toarray()
+            _, order, ions = self._column_index()
+            ext = (self.index[0], self.index[-1],
+                   np.nanmin(ions), np.nanmax(ions))
+            if scipy.sparse.issparse(self.values):
+                # the image itself has to be dense
+                grid = self._csc()[:, order].transpose().toarray()
+            else:
+                grid = self.values[:, order].transpose()
             img = ax.imshow(grid, origin='lower', aspect='auto',
                             extent=ext, cmap=cmap)
             if legend:
@@ -308,7 +469,7 @@ class Chromatogram(object):
             from aston.peak.peak_models import gaussian
             from matplotlib.colors import ListedColormap
 
-            wvs = np.genfromtxt(np.array(self.columns).astype(bytes))
+            wvs = self._column_index()[0]
             # wvs = self.columns.astype(float)
 
             # http://www.ppsloan.org/publications/XYZJCGT.pdf
@@ -319,10 +480,8 @@ class Chromatogram(object):
                                            w=0.075)
             vis_filt[2] = 1.839 * gaussian(np.log(wvs), x=np.log(449.8),
                                            w=0.051)
-            if isinstance(self.values, scipy.sparse.spmatrix):
-                xyz = np.dot(self.values.toarray(), vis_filt.T)
-            else:
-                xyz = np.dot(self.values.copy(), vis_filt.T)
+            # (this is a dense array even if the values are sparse)
+            xyz = self.values.dot(vis_filt.T)
 
             # http://www.brucelindbloom.com/index.html?Eqn_RGB_XYZ_Matrix.html
             xyz_rgb = [[3.2404542, -1.5371385, -0.4985314],
@@ -396,7 +555,7 @@ class Chromatogram(object):
                 continue
             print(str(i) + '/' + str(self.shape[1]))
             inter_x = np.linspace(0, 1, wav[::mz_to_wv(mz)].shape[0])
-            wav[::mz_to_wv(mz)] += np.interp(inter_x, tmask, self.values[:, i])
+            wav[::mz_to_wv(mz)] += np.interp(inter_x, tmask, self._column(i))
 
         # scale the new array and write it out
         scaled = wav / np.max(np.abs(wav))
@@ -404,9 +563,38 @@ class Chromatogram(object):
         scaled = np.int16(scaled * 32767)
         scipy.io.wavfile.write(filename, 44100, scaled)
 
-    def scans(self):
-        for t in self.index:
-            yield self.scan(t)
+    def scans(self, twin=None):
+        """
+        Goes through the spectra at each time in turn.
+
+        Parameters
+        ----------
+        twin : tuple, optional
+            Only return the spectra between these two times.
+
+        Yields
+        ------
+        Scan
+            The abundances are views into this Chromatogram (and not
+            copies) so they should not be changed. For sparse values,
+            each Scan only has the columns stored for that row.
+        """
+        st_idx, en_idx = _slice_idxs(self, twin)
+        if not scipy.sparse.issparse(self.values):
+            for idx in range(st_idx, en_idx):
+                yield Scan(self.columns, self.values[idx],
+                           name=self.index[idx])
+            return
+
+        vals = self.values
+        cols = np.asarray(self.columns)
+        if cols.dtype.kind not in 'biuf':
+            # don't let numpy turn mixed labels into strings
+            cols = np.asarray(self.columns, dtype=object)
+        for idx in range(st_idx, en_idx):
+            st, en = vals.indptr[idx], vals.indptr[idx + 1]
+            yield Scan(cols[vals.indices[st:en]], vals.data[st:en],
+                       name=self.index[idx])
 
     def scan(self, t, dt=None, aggfunc=None):
         """
@@ -416,37 +604,94 @@ class Chromatogram(object):
         ----------
         t : float
         dt : float
+            If set, the spectra from t to t + dt are summed together
+            (see scan_range).
+        aggfunc : function, optional
+            Combines the rows of spectra from t to t + dt instead.
+        """
+        if dt is not None:
+            return self.scan_range(t, t + dt, agg=aggfunc)
+
+        # only take the spectra at the nearest time
+        idx = _nearest_idx(self, t)
+        return Scan(self.columns, self._row(idx).copy(), name=self.index[idx])
+
+    def scan_range(self, t0, t1, agg=None):
         """
-        idx = (np.abs(self.index - t)).argmin()
+        Combines all of the spectra between two times into one.
+
+        Parameters
+        ----------
+        t0, t1 : float
+        agg : {'sum', 'mean', 'max', 'min'} or function, optional
+            How to combine the spectra (the default is summing them). A
+            function is passed the (sparse, if the values are) rows.
 
-        if dt is None:
-            # only take the spectra at the nearest time
-            mz_abn = self.values[idx, :].copy()
+        Returns
+        -------
+        Scan
+        """
+        if t1 < t0:
+            t0, t1 = t1, t0
+        st_idx, en_idx = _slice_idxs(self, (t0, t1))
+        # (slicing rows out of sparse values already copies them)
+        rows = self.values[st_idx:en_idx]
+        if agg is None:
+            agg = 'sum'
+        if agg in ('sum', 'mean', 'max', 'min'):
+            mz_abn = getattr(rows, agg)(axis=0)
+        elif scipy.sparse.issparse(rows):
+            mz_abn = agg(rows)
         else:
-            # sum up all the spectra over a range
-            en_idx = (np.abs(self.index - t - dt)).argmin()
-            idx, en_idx = min(idx, en_idx), max(idx, en_idx)
-            if aggfunc is None:
-                mz_abn = self.values[idx:en_idx + 1, :].copy().sum(axis=0)
-            else:
-                mz_abn = aggfunc(self.values[idx:en_idx + 1, :].copy())
-        if isinstance(mz_abn, scipy.sparse.spmatrix):
-            mz_abn = mz_abn.toarray()[0]
-        return Scan(self.columns, mz_abn)
+            mz_abn = agg(rows.copy())
+
+        if scipy.sparse.issparse(mz_abn):
+            mz_abn = mz_abn.toarray()
+        if isinstance(mz_abn, np.matrix) or np.ndim(mz_abn) > 1:
+            # reductions over sparse rows come back as 1 x n matrices
+            mz_abn = np.asarray(mz_abn)[0]
+        # named with the first time in the window, like scan(t)
+        name = self.index[st_idx] if st_idx < len(self.index) else ''
+        return Scan(self.columns, mz_abn, name=name)
+
+    def _row(self, i):
+        """
+        The (dense) values in the ith row.
+        """
+        if not scipy.sparse.issparse(self.values):
+            return self.values[i]
+        vals = self.values
+        row = np.zeros(self.shape[1], dtype=vals.dtype)
+        st, en = vals.indptr[i], vals.indptr[i + 1]
+        row[vals.indices[st:en]] = vals.data[st:en]
+        return row
 
     def compress(self):
         """
         Serializes the AstonFrame into a binary stream.
 
+        Sparse values are written out as their CSR arrays (and the
+        columns are flagged as being sparse) so they're never
+        expanded.
+
         Returns
         -------
         bytes
         """
-        i = self.index.astype(np.float32).tostring()
+        i = self.index.astype(np.float32).tobytes()
         li = struct.pack('<L', len(i))
-        c = json.dumps(self.columns).encode('utf-8')
+        cols = [c.item() if isinstance(c, np.generic) else c
+                for c in self.columns]
+        if scipy.sparse.issparse(self.values):
+            cols = {'columns': cols, 'sparse': 'csr',
+                    'nnz': int(self.values.nnz)}
+            v = self.values.data.astype(np.float64).tobytes() + \
+                self.values.indices.astype('<i4').tobytes() + \
+                self.values.indptr.astype('<i4').tobytes()
+        else:
+            v = self.values.astype(np.float64).tobytes()
+        c = json.dumps(cols).encode('utf-8')
         lc = struct.pack('<L', len(c))
-        v = self.values.astype(np.float64).tostring()
         try:  # python 2
             return buffer(zlib.compress(lc + li + c + i + v))
         except NameError:  # python 3
@@ -471,14 +716,32 @@ def decompress(zdata):
     li = struct.unpack('<L', data[4:8])[0]
     c = json.loads(data[8:8 + lc].decode('utf-8'))
     i = np.frombuffer(data[8 + lc:8 + lc + li], dtype=np.float32)
-    v = np.frombuffer(data[8 + lc + li:], dtype=np.float64)
 
+    if isinstance(c, dict):
+        # sparse; the data, column indices and row pointers of a CSR
+        nnz, st = c['nnz'], 8 + lc + li
+        v = np.frombuffer(data, dtype=np.float64, count=nnz, offset=st)
+        idxs = np.frombuffer(data, dtype='<i4', count=nnz, offset=st + 8 * nnz)
+        ptrs = np.frombuffer(data, dtype='<i4', count=len(i) + 1,
+                             offset=st + 12 * nnz)
+        v = scipy.sparse.csr_matrix((v, idxs, ptrs),
+                                    shape=(len(i), len(c['columns'])))
+        return Chromatogram(v, i, c['columns'])
+
+    v = np.frombuffer(data[8 + lc + li:], dtype=np.float64)
     if len(c) == 1:
         return Trace(v, i, name=c[0])
     else:
         return Chromatogram(v.reshape(len(i), len(c)), i, c)
 
 
+def _to_float(c):
+    try:
+        return float(c)
+    except (TypeError, ValueError):
+        return np.nan
+
+
 def _slice_idxs(df, twin=None):
     """
     Returns a slice of the incoming array filtered between
@@ -488,14 +751,37 @@ def _slice_idxs(df, twin=None):
     if twin is None:
         return 0, df.shape[0]
 
-    tme = df.index
-
     if twin[0] is None:
         st_idx = 0
     else:
-        st_idx = (np.abs(tme - twin[0])).argmin()
+        st_idx = _nearest_idx(df, twin[0])
     if twin[1] is None:
         en_idx = df.shape[0]
     else:
-        en_idx = (np.abs(tme - twin[1])).argmin() + 1
+        en_idx = _nearest_idx(df, twin[1]) + 1
     return st_idx, en_idx
+
+
+def _nearest_idx(df, t):
+    """
+    Finds the (first) position in the index of df whose time is
+    closest to t, by bisection if the times are in order.
+    """
+    tme = df.index
+    # whether the times are sorted is saved with the index it was
+    # checked against, so it's redone if the index is replaced
+    mono_idx, mono = getattr(df, '_monotonic', (None, None))
+    if mono_idx is not tme:
+        mono = bool(np.all(tme[1:] >= tme[:-1]))
+        df._monotonic = (tme, mono)
+
+    if not mono:
+        return (np.abs(tme - t)).argmin()
+    elif len(tme) == 0:
+        return 0
+
+    idx = np.searchsorted(tme, t)
+    if idx == len(tme) or (idx > 0 and t - tme[idx - 1] <= tme[idx] - t):
+        # step back to the first of any repeated times too
+        idx = np.searchsorted(tme, tme[idx - 1])
+    return idx
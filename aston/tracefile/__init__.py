@@ -3,30 +3,94 @@ Classes that can open chromatographic files and return
 info from them or Traces/Chromatograms.
 '''
 
+import hashlib
+import io
+import json
+import mmap
+import os
 import re
+import shutil
 import struct
+import tempfile
 
 import numpy as np
+import scipy.sparse
 
+from aston import __version__
 from aston.trace import Chromatogram, Trace
-from aston.tracefile.mime import get_mimetype, tfclasses
+from aston.tracefile.mime import get_mimetype, tfclass
+
+
+def _map_file(f):
+    """
+    Returns a read-only memory map of an open file (or just the
+    contents, for in-memory files that can't be mapped).
+    """
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, io.UnsupportedOperation, ValueError):
+        # e.g. io.BytesIO (no fileno) or an empty file
+        f.seek(0)
+        return f.read()
 
 
 def find_offset(f, search_str, hint=None):
+    """
+    Returns the offset just past the first match of the regular
+    expression search_str in the file (after hint, if given), or None
+    if it's not found.
+    """
     if hint is None:
         hint = 0
-    f.seek(hint)
-    regexp = re.compile(search_str)
-    while True:
-        d = f.read(len(search_str) * 200)
-        srch = regexp.search(d)
-        if srch is not None:
-            foff = f.tell() - len(d) + srch.end()
-            break
-        if len(d) == len(search_str):  # no data read: EOF
-            return None
-        f.seek(f.tell() - len(search_str))
-    return foff
+    buf = _map_file(f)
+    try:
+        srch = re.compile(search_str).search(buf, hint)
+        return None if srch is None else srch.end()
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+
+def c_serialized_records(f):
+    """
+    Finds the records in a binary file created by a C++ serializer
+    (prob. MFC?); these are used by Thermo for *.CF and *.DXF files and
+    by Agilent for new-style *.REG files.
+
+    Each record starts with a class marker: two 0xFF bytes, two
+    little-endian shorts (the second being the length of the class name)
+    and then a class name starting with 'C'.
+
+    Yields
+    ------
+    tuple
+        (record type, offset, length) of the data following each class
+        marker (up until the next one), as the file is scanned.
+    """
+    buf = _map_file(f)
+    try:
+        prev_type, prev_off = None, None
+        resume = 0
+        for cand in re.finditer(b'(?=\xff\xff)', buf):
+            pos = cand.start()
+            if pos < resume or pos + 6 > len(buf):
+                continue
+            nlen = struct.unpack_from('<H', buf, pos + 4)[0]
+            if 0 < nlen < 64:
+                rec_type = buf[pos + 6:pos + 6 + nlen]
+                if rec_type[:1] == b'C':
+                    if prev_type is not None:
+                        yield prev_type, prev_off, pos - prev_off
+                    prev_type, prev_off = rec_type, pos + 6 + nlen
+                    resume = prev_off
+                    continue
+            # not a real marker; skip over what was read of it
+            resume = pos + 5 + (nlen if 0 < nlen < 64 else 0)
+        if prev_type is not None:
+            yield prev_type, prev_off, len(buf) - prev_off
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
 
 
 def parse_c_serialized(f):
@@ -36,33 +100,139 @@ def parse_c_serialized(f):
     These are used by Thermo for *.CF and *.DXF files and by Agilent
     for new-style *.REG files.
     """
-    # TODO: rewrite to use re library
-    f.seek(0)
-    try:
-        p_rec_type = None
-        while True:
-            rec_off = f.tell()
-            while True:
-                if f.read(2) == b'\xff\xff':
-                    h = struct.unpack('<HH', f.read(4))
-                    if h[1] < 64 and h[1] != 0:
-                        rec_type = f.read(h[1])
-                        if rec_type[0] == 67:  # starts with 'C'
-                            break
-                if f.read(1) == b'':
-                    raise EOFError
-                f.seek(f.tell() - 2)
-            if p_rec_type is not None:
-                rec_len = f.tell() - 6 - len(rec_type) - rec_off
-                f.seek(rec_off)
-                yield p_rec_type, f.read(rec_len)
-                f.seek(f.tell() + 6 + len(rec_type))
-            # p_type = h[0]
-            p_rec_type = rec_type
-    except EOFError:
-        rec_len = f.tell() - 6 - len(rec_type) - rec_off
+    for rec_type, rec_off, rec_len in c_serialized_records(f):
         f.seek(rec_off)
-        yield p_rec_type, f.read(rec_len)
+        yield rec_type, f.read(rec_len)
+
+
+# directory to keep decoded data in between sessions (if not None)
+_CACHE_DIR = os.environ.get('ASTON_CACHE_DIR')
+
+
+def set_cache_dir(path):
+    """
+    Sets the directory decoded Chromatograms are kept in between
+    sessions; setting it to None turns off this caching.
+    """
+    global _CACHE_DIR
+    _CACHE_DIR = path
+
+
+def _cache_path(tf):
+    """
+    Returns the directory a TraceFile's data is (or would be) cached
+    in; changing the file (or any other file it's read along with) or
+    the code reading it changes this.
+    """
+    key = [type(tf).__module__, type(tf).__name__, __version__]
+    for fname in [tf.filename] + sorted(tf._cache_deps()):
+        try:
+            st = os.stat(fname)
+            key += [os.path.abspath(fname), str(st.st_size),
+                    repr(st.st_mtime)]
+        except OSError:
+            key += [os.path.abspath(fname), 'missing']
+    key = '|'.join(key)
+    return os.path.join(_CACHE_DIR,
+                        hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def _load_cached(path):
+    """
+    Reads a Chromatogram back out of the cache, or returns None if it
+    can't be read (clearing out the entry if it's damaged).
+    """
+    try:
+        return _read_cached(path)
+    except (ValueError, KeyError, EOFError, FileNotFoundError):
+        # e.g. truncated arrays, missing arrays or bad JSON; this
+        # gets rewritten
+        shutil.rmtree(path, ignore_errors=True)
+    except OSError:
+        # e.g. out of file descriptors or no permission; the entry
+        # itself is fine, so leave it for next time
+        pass
+
+
+def _read_cached(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    def ld(name, mmap_mode='c'):
+        # copy-on-write, so the data can be modified in memory; every
+        # map holds a file descriptor open, so small arrays are just
+        # read in
+        return np.load(os.path.join(path, name + '.npy'),
+                       mmap_mode=mmap_mode)
+
+    if meta['sparse']:
+        values = scipy.sparse.csr_matrix((ld('data'), ld('indices'),
+                                          ld('indptr', None)),
+                                         shape=tuple(meta['shape']))
+    else:
+        values = ld('values')
+    columns = ld('columns', None)
+    if meta['list_columns']:
+        columns = columns.tolist()
+    return Chromatogram(values, ld('index', None), columns, meta['yunits'])
+
+
+def _save_cached(path, chrom):
+    columns = np.asarray(chrom.columns)
+    if columns.dtype.kind == 'O':
+        # can't be memory-mapped back in, so don't bother
+        return
+    arrays = {'index': np.asarray(chrom.index), 'columns': columns}
+    if scipy.sparse.issparse(chrom.values):
+        values = chrom.values.tocsr()
+        arrays.update(data=values.data, indices=values.indices,
+                      indptr=values.indptr)
+    else:
+        arrays['values'] = np.asarray(chrom.values)
+    meta = {'sparse': scipy.sparse.issparse(chrom.values),
+            'shape': list(chrom.values.shape), 'yunits': chrom.yunits,
+            'list_columns': isinstance(chrom.columns, list)}
+
+    # write everything out elsewhere and then move it into place
+    # so a half-written entry is never read back in
+    tmp_path = None
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=_CACHE_DIR)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), arr)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, path)
+    except OSError:
+        # e.g. another process cached the same file first, or the
+        # cache directory is read-only or full; the data's still fine
+        if tmp_path is not None:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def disk_cache(func):
+    """
+    Decorator for TraceFile.data properties that, if a cache directory
+    is set, saves the decoded Chromatogram there and memory-maps it back
+    in the next time the same (unchanged) file is opened.
+    """
+    def wrapper(self):
+        if _CACHE_DIR is None or self.filename is None:
+            return func(self)
+        path = _cache_path(self)
+        if os.path.isdir(path):
+            chrom = _load_cached(path)
+            if chrom is not None:
+                return chrom
+        chrom = func(self)
+        if chrom is None:
+            return chrom
+        _save_cached(path, chrom)
+        return chrom
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
 
 
 class TraceFile(object):
@@ -92,10 +262,9 @@ class TraceFile(object):
 
             ftype = get_mimetype(filename, magic)
 
-            if ftype is not None:
-                if ftype in tfclasses():
-                    self.__class__ = tfclasses()[ftype]
-                    self.ftype = ftype
+            if tfclass(ftype) is not None:
+                self.__class__ = tfclass(ftype)
+                self.ftype = ftype
         else:
             self.ftype = self.__class__.__name__
 
@@ -192,6 +361,13 @@ class TraceFile(object):
         # example: [0.1], [147, 178]
         return [], []
 
+    def _cache_deps(self):
+        """
+        Other files that data is decoded from (besides filename), so
+        changing them means the disk cache is redone.
+        """
+        return []
+
     def md5hash(self):
         # TODO: calculate md5hash of this file
         # to be used for determining if files in db are unique
@@ -257,3 +433,70 @@ class ScanListFile(TraceFile):
         # merge bin_scans and return
         # FIXME
         pass
+
+
+def _load_one(filename, what):
+    """
+    Opens a single file and pulls out each of the properties
+    (or the results of each of the methods) named in `what`.
+    """
+    try:
+        tf = TraceFile(filename)
+        res = {}
+        for w in what:
+            attr = getattr(tf, w)
+            res[w] = attr() if callable(attr) else attr
+        return filename, res, None
+    except Exception as e:
+        return filename, None, e
+
+
+def load_many(filenames, what=('data', 'info'), workers=None,
+              progress=None):
+    """
+    Opens many files at once over a pool of processes.
+
+    Parameters
+    ----------
+    filenames : list
+        Paths to the files to open.
+    what : tuple, optional
+        Names of the properties (e.g. 'data', 'info') or methods
+        (e.g. 'total_trace') to read out of every file.
+    workers : int, optional
+        Number of processes to use (by default, one per core). If 1,
+        the files are read one after another in this process.
+    progress : callable, optional
+        Called as progress(n_done, n_total) after each file is read.
+
+    Yields
+    ------
+    tuple
+        (filename, {name: value}, error) for every file in the order
+        they finish reading; if reading a file raised an exception, the
+        dictionary is None and error is the exception.
+    """
+    filenames = list(filenames)
+    what = tuple(what)
+    if workers == 1:
+        results = (_load_one(fn, what) for fn in filenames)
+        for n_done, res in enumerate(results, 1):
+            if progress is not None:
+                progress(n_done, len(filenames))
+            yield res
+        return
+
+    # this pulls in multiprocessing, so only import it when needed
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_load_one, fn, what): fn
+                   for fn in filenames}
+        for n_done, future in enumerate(as_completed(futures), 1):
+            try:
+                res = future.result()
+            except Exception as e:
+                # e.g. the results could not be sent back
+                res = futures[future], None, e
+            if progress is not None:
+                progress(n_done, len(filenames))
+            yield res
@@ -4,6 +4,69 @@ from aston.trace import Trace
 from aston.tracefile import TraceFile
 
 
+def double_delta_decode(words):
+    """
+    Decodes the "double delta" compression used in Agilent FID files.
+
+    Each int16 word is the change in the slope of the trace, except
+    for 32767 which marks that the next six bytes are an absolute
+    value (an int32 and a uint16) from which the trace restarts flat.
+
+    Parameters
+    ----------
+    words : np.ndarray
+        big-endian int16 words of the data section
+
+    Returns
+    -------
+    np.ndarray
+        int64 array of the decoded values
+    """
+    words = np.asarray(words)
+
+    # find the escapes; an escape's absolute value can contain a 32767
+    # too, so any within three words of each other are checked in order
+    esc = np.flatnonzero(words == 32767)
+    esc = esc[esc + 3 < len(words)]
+    valid = np.ones(len(esc), dtype=bool)
+    for i in np.flatnonzero(np.diff(esc) <= 3) + 1:
+        j = i - 1
+        while j >= 0 and esc[i] - esc[j] <= 3:
+            if valid[j]:
+                valid[i] = False
+                break
+            j -= 1
+    esc = esc[valid]
+
+    absval = (words[esc + 1].astype(np.int64) << 16 |
+              words[esc + 2].astype(np.int64) & 0xFFFF) * 65534 + \
+        (words[esc + 3].astype(np.int64) & 0xFFFF)
+
+    # drop the absolute values out so there's one word per point
+    mask = np.ones(len(words), dtype=bool)
+    for i in range(1, 4):
+        mask[esc + i] = False
+    # the trace starts flat from zero, so we add a fake escape to the
+    # front to make things simpler
+    ddelts = np.hstack([0, words[mask]]).astype(np.int64)
+    tesc = np.hstack([0, esc - 3 * np.arange(len(esc)) + 1])
+    ddelts[tesc] = 0
+    base = np.zeros(len(ddelts), dtype=np.int64)
+    base[tesc] = np.hstack([0, absval])
+
+    # index of the last escape at or before every point
+    is_esc = np.zeros(len(ddelts), dtype=bool)
+    is_esc[tesc] = True
+    last = np.maximum.accumulate(np.where(is_esc, np.arange(len(ddelts)), 0))
+
+    # the slope is reset at every escape, and then the
+    # trace is built back up from the slope
+    delts = np.cumsum(ddelts)
+    delts -= delts[last]
+    vals = np.cumsum(delts)
+    return (vals - vals[last] + base[last])[1:]
+
+
 class AgilentFID(TraceFile):
     # TODO: preliminary support, math may not be correct
     """
@@ -27,24 +90,9 @@ class AgilentFID(TraceFile):
         # FIXME: why is there this del_ab code here?
         # f.seek(0x284)
         # del_ab = struct.unpack('>d', f.read(8))[0]
-        data = []
 
         f.seek(0x400)
-        delt = 0
-        while True:
-            try:
-                inp = struct.unpack('>h', f.read(2))[0]
-            except struct.error:
-                break
-
-            if inp == 32767:
-                inp = struct.unpack('>i', f.read(4))[0]
-                inp2 = struct.unpack('>H', f.read(2))[0]
-                delt = 0
-                data.append(inp * 65534 + inp2)
-            else:
-                delt += inp
-                data.append(data[-1] + delt)
+        data = double_delta_decode(np.fromfile(f, dtype='>i2'))
         f.close()
         # TODO: 0.4/60.0 should be obtained from the file???
         times = np.array(start_time + np.arange(len(data)) * (0.2 / 60.0))
@@ -1,16 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import os.path as op
-import gzip
-import io
 import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from xml.etree import ElementTree
 import numpy as np
 import scipy.sparse
 from aston.cache import cache
 from aston.trace import Trace, Chromatogram
-from aston.tracefile import TraceFile, ScanListFile
+from aston.tracefile import TraceFile, ScanListFile, disk_cache
 from aston.spectra import Scan
 
 
@@ -18,36 +18,16 @@ class AgilentMS(TraceFile):
     mime = 'application/vnd-agilent-chemstation-ms'
     traces = ['#ms']
 
-    def total_trace(self, twin=None):
-        # TODO: use twin?
-        f = open(self.filename, 'rb')
-
-        # get number of scans to read in
-        f.seek(0x5)
-        if f.read(4) == 'GC':
-            f.seek(0x142)
-        else:
-            f.seek(0x118)
-        nscans = struct.unpack('>H', f.read(2))[0]
-
-        # find the starting location of the data
-        f.seek(0x10A)
-        f.seek(2 * struct.unpack('>H', f.read(2))[0] - 2)
-
-        tme = np.zeros(nscans)
-        tic = np.zeros(nscans)
-        for i in range(nscans):
-            npos = f.tell() + 2 * struct.unpack('>H', f.read(2))[0]
-            tme[i] = struct.unpack('>I', f.read(4))[0] / 60000.
-            f.seek(npos - 4)
-            tic[i] = struct.unpack('>I', f.read(4))[0]
-            f.seek(npos)
-        f.close()
-        return Trace(tic, tme, name='TIC')
-
     @property
-    @cache(maxsize=1)
-    def data(self):
+    def _scan_index(self):
+        """
+        A table of the byte offset, number of points, time and TIC of
+        every scan in the file. This is built once per file and then
+        used to read only the scans needed out of a memory map.
+        """
+        if getattr(self, '_scan_idx', None) is not None:
+            return self._scan_idx
+
         f = open(self.filename, 'rb')
 
         # get number of scans to read in
@@ -60,63 +40,91 @@ class AgilentMS(TraceFile):
             f.seek(0x118)
         nscans = struct.unpack('>H', f.read(2))[0]
 
+        # find the starting location of the data
         f.seek(0x10A)
-        f.seek(2 * struct.unpack('>H', f.read(2))[0] - 2)
-        dstart = f.tell()
-
-        # determine total number of measurements in file
-        tot_pts = 0
-        rowst = np.empty(nscans + 1, dtype=int)
-        rowst[0] = 0
-
-        for scn in range(nscans):
-            # get the position of the next scan
-            npos = f.tell() + 2 * struct.unpack('>H', f.read(2))[0]
-
-            # keep a running total of how many measurements
-            tot_pts += (npos - f.tell() - 26) // 4
-            rowst[scn + 1] = tot_pts
-
-            # move forward
-            f.seek(npos)
+        dstart = 2 * struct.unpack('>H', f.read(2))[0] - 2
+        f.close()
 
-        # go back to the beginning and load all the other data
-        f.seek(dstart)
-
-        ions = []
-        i_lkup = {}
-        cols = np.empty(tot_pts, dtype=int)
-        vals = np.empty(tot_pts, dtype=np.int32)
-        times = np.empty(nscans)
+        # every field in the data block is word-aligned so we
+        # can address the whole file as '>H's
+        words = self._words()
 
+        # each scan starts with its own length (in words), so
+        # we have to hop through once to find where they all start
+        offs = np.empty(nscans + 1, dtype=int)
+        pos = dstart // 2
         for scn in range(nscans):
-            npos = f.tell() + 2 * struct.unpack('>H', f.read(2))[0]
-
-            # the sampling rate is evidentally 60 kHz on all Agilent's MS's
-            times[scn] = struct.unpack('>I', f.read(4))[0] / 60000.
-
-            f.seek(f.tell() + 12)
-            npts = rowst[scn + 1] - rowst[scn]
-            mzs = struct.unpack('>' + npts * 'HH', f.read(npts * 4))
+            offs[scn] = pos
+            pos += int(words[pos])
+        offs[nscans] = pos
+
+        idx = np.empty(nscans, dtype=[('offset', int), ('npts', int),
+                                      ('time', float), ('tic', float)])
+        idx['offset'] = 2 * offs[:-1]
+        # 18 bytes of scan header and 10 bytes of trailer around the
+        # 4 byte (mz, abundance) pairs
+        idx['npts'] = (np.diff(offs) - 14) // 2
+        # the sampling rate is evidentally 60 kHz on all Agilent's MS's
+        idx['time'] = ((words[offs[:-1] + 1].astype(np.uint32) << 16) |
+                       words[offs[:-1] + 2]) / 60000.
+        idx['tic'] = ((words[offs[1:] - 2].astype(np.uint32) << 16) |
+                      words[offs[1:] - 1])
+
+        self._scan_idx = idx
+        return idx
+
+    def _words(self):
+        return np.memmap(self.filename, dtype='>u2', mode='r',
+                         shape=(op.getsize(self.filename) // 2,))
 
-            # there's some bug in the numpy implementation that makes this fail
-            # after the first time
-            # mzs = np.fromfile(f, dtype='>H', count=npts * 2)
-
-            nions = set(mzs[0::2]).difference(i_lkup)
-            i_lkup.update({ion: i + len(ions) for i, ion in enumerate(nions)})
-            ions += nions
-
-            cols[rowst[scn]:rowst[scn + 1]] = [i_lkup[i] for i in mzs[0::2]]
-            vals[rowst[scn]:rowst[scn + 1]] = mzs[1::2]
-            f.seek(npos)
-        f.close()
+    def total_trace(self, twin=None):
+        idx = self._scan_index
+        return Trace(idx['tic'], idx['time'], name='TIC').twin(twin)
 
-        vals = ((vals & 16383) * 8 ** (vals >> 14)).astype(float)
+    @property
+    @cache(maxsize=1)
+    @disk_cache
+    def data(self):
+        idx = self._scan_index
+        mzs, vals, rowst = _read_ms_points(self._words(), idx)
+        ions, cols = np.unique(mzs, return_inverse=True)
         data = scipy.sparse.csr_matrix((vals, cols, rowst),
-                                       shape=(nscans, len(ions)), dtype=float)
-        ions = np.array(ions) / 20.
-        return Chromatogram(data, times, ions)
+                                       shape=(len(idx), len(ions)),
+                                       dtype=float)
+        ions = ions / 20.
+        return Chromatogram(data, idx['time'], ions)
+
+    def scan(self, t, dt=None, aggfunc=None):
+        """
+        Returns the spectrum from a specific time or range of times,
+        only reading the scans needed from disk.
+        """
+        idx = self._scan_index
+        st_idx = (np.abs(idx['time'] - t)).argmin()
+        if dt is None:
+            en_idx = st_idx
+        else:
+            en_idx = (np.abs(idx['time'] - t - dt)).argmin()
+            st_idx, en_idx = min(st_idx, en_idx), max(st_idx, en_idx)
+
+        rows = idx[st_idx:en_idx + 1]
+        mzs, vals, rowst = _read_ms_points(self._words(), rows)
+        ions, cols = np.unique(mzs, return_inverse=True)
+        if aggfunc in (None, 'sum'):
+            abn = np.bincount(cols, weights=vals, minlength=len(ions))
+        else:
+            pts = scipy.sparse.csr_matrix((vals, cols, rowst),
+                                          shape=(len(rows), len(ions)),
+                                          dtype=float)
+            # the same names as Chromatogram.scan_range takes
+            if aggfunc in ('mean', 'max', 'min'):
+                abn = getattr(pts, aggfunc)(axis=0)
+            else:
+                abn = aggfunc(pts)
+            if isinstance(abn, scipy.sparse.spmatrix):
+                abn = abn.toarray()
+            abn = np.asarray(abn).ravel()
+        return Scan(ions / 20., abn, name=rows['time'][0])
 
     @property
     @cache(maxsize=1)
@@ -209,136 +217,175 @@ class AgilentMS(TraceFile):
         return d
 
 
+def _read_ms_points(words, idx):
+    """
+    Gathers the mzs and abundances for every scan in `idx` (a slice
+    of AgilentMS._scan_index) out of the file's '>H' words. Returns
+    the raw mzs, the decoded abundances and the CSR row pointers.
+    """
+    rowst = np.zeros(len(idx) + 1, dtype=int)
+    np.cumsum(idx['npts'], out=rowst[1:])
+
+    # word positions of every mz to be read in
+    pt_locs = np.repeat(idx['offset'] // 2 + 9 - 2 * rowst[:-1],
+                        idx['npts']) + 2 * np.arange(rowst[-1])
+    mzs = words[pt_locs]
+    vals = words[pt_locs + 1]
+
+    # abundances are a 14-bit mantissa and a 2-bit (base 8) exponent
+    vals = (vals & 16383) * 8. ** (vals >> 14)
+    return mzs, vals, rowst
+
+
 class AgilentMSMSScan(ScanListFile):
     mime = 'application/vnd-agilent-masshunter-msmsscan'
     traces = ['#ms']
 
     # TODO: __init__ method that adds mrm trace names to traces
-    def _scan_iter(self, keylist):
-        f = open(self.filename, 'rb')
-        r = ElementTree.parse(op.splitext(self.filename)[0] + '.xsd').getroot()
-
-        xml_to_struct = {'xs:int': 'i', 'xs:long': 'q', 'xs:short': 'h',
-                         'xs:byte': 'b', 'xs:double': 'd', 'xs:float': 'f'}
-        rfrmt = {}
-
-        for n in r.getchildren():
-            name = n.get('name')
-            for sn in n.getchildren()[0].getchildren():
-                if rfrmt.get(name, None) is None:
-                    rfrmt[name] = []
-                sname = sn.get('name')
-                stype = sn.get('type')
-                rfrmt[name].append((sname, xml_to_struct.get(stype, stype)))
-
-        def resolve(lookup, recname):
-            names = [i[0] for i in lookup[recname]]
-            frmts = [i[1] for i in lookup[recname]]
-            flatnames = []
-            flatfrmts = ''
-            for n, f in zip(names, frmts):
-                if len(f) != 1:
-                    n, f = resolve(lookup, f)
-                    flatnames += n
-                else:
-                    flatnames.append(n)
-                flatfrmts += f
-            return flatnames, flatfrmts
-
-        fnames, ffrmts = resolve(rfrmt, 'ScanRecordType')
-        rec_str = '<' + ffrmts
-        sz = struct.calcsize(rec_str)
-
-        f.seek(0x58)
-        start_offset = struct.unpack('<i', f.read(4))[0]
-        f.seek(start_offset)
-
-        locations = [fnames.index(k) for k in keylist]
-        while True:
-            try:
-                data = struct.unpack(rec_str, f.read(sz))
-            except struct.error:
-                break
-            yield (data[loc] for loc in locations)
-        f.close()
-
-    def total_trace(self, twin=None):
-        if twin is None:
-            twin = (-np.inf, np.inf)
-        tme = []
-        tic = []
-        for t, z in self._scan_iter(['ScanTime', 'TIC']):
-            if t < twin[0]:
-                continue
-            elif t > twin[1]:
-                break
-            tme.append(t)
-            tic.append(z)
-        return Trace(np.array(tic), np.array(tme), name='TIC')
-        # TODO: set .twin(twin) bounds on this
-
-    def scans(self, twin=None):
+    @property
+    def _scan_table(self):
+        """
+        The scan records (times, TICs, offsets into MSProfile.bin,
+        etc.) for every scan in the file, read in as one array.
+        """
+        if getattr(self, '_scan_tab', None) is not None:
+            return self._scan_tab
+
+        dtype = _xsd_dtype(op.splitext(self.filename)[0] + '.xsd',
+                           'ScanRecordType')
+        with open(self.filename, 'rb') as f:
+            f.seek(0x58)
+            start_offset = struct.unpack('<i', f.read(4))[0]
+            f.seek(0, 2)
+            nrecs = (f.tell() - start_offset) // dtype.itemsize
+            f.seek(start_offset)
+            self._scan_tab = np.fromfile(f, dtype=dtype, count=nrecs)
+        return self._scan_tab
+
+    def _twin_mask(self, twin):
+        t = self._scan_table['ScanTime']
         if twin is None:
-            twin = (-np.inf, np.inf)
-
-        # super hack-y way to disable checksum and length checking
-        gzip.GzipFile._read_eof = lambda _: None  # noqa
-        # standard prefix for every zip chunk
-        gzprefix = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x04\x00'
-
-        def uncompress(d):
-            return gzip.GzipFile(fileobj=io.BytesIO(gzprefix + d)).read()
-
-        f = open(op.join(op.split(self.filename)[0], 'MSProfile.bin'), 'rb')
+            return np.ones(len(t), dtype=bool)
+        return (t >= twin[0]) & (t <= twin[1])
 
+    def total_trace(self, twin=None):
+        tab = self._scan_table[self._twin_mask(twin)]
+        return Trace(tab['TIC'], tab['ScanTime'], name='TIC')
+
+    def scans(self, twin=None, workers=None):
+        """
+        Reads in the profile spectra for every scan in twin.
+
+        Parameters
+        ----------
+        twin : tuple, optional
+            Only return scans between these times.
+        workers : int, optional
+            Number of threads to decompress spectra with (by default,
+            as many as the thread pool uses); if 1, they're
+            decompressed in this thread.
+        """
         flds = ['ScanTime', 'SpectrumFormatID', 'SpectrumOffset',
                 'ByteCount', 'PointCount', 'MinX', 'MaxX']
-
-        for t, fmt, off, bc, pc, minx, maxx in self._scan_iter(flds):
-            if t < twin[0]:
-                continue
-            if t > twin[1]:
-                break
-
-            f.seek(off)
-            if fmt == 1:
-                # this record is compressed with gz
-                profdata = uncompress(f.read(bc))
-                pd = np.array(struct.unpack('dd' + pc * 'i', profdata)[2:])
-            elif fmt == 2:
-                profdata = f.read(bc)
-                pd = np.array(struct.unpack('dd' + pc * 'f', profdata)[2:])
+        tab = self._scan_table[self._twin_mask(twin)]
+        recs = list(zip(*(tab[i].tolist() for i in flds)))
+
+        prof_file = op.join(op.split(self.filename)[0], 'MSProfile.bin')
+        with open(prof_file, 'rb') as f:
+            # zlib lets go of the GIL while decompressing, so scans are
+            # read in batches and then decompressed over several threads
+            if workers == 1:
+                pool, pool_map = None, map
             else:
-                raise NotImplementedError('Unknown Agilent MH Scan format')
-            # TODO: probably not a good approximation?
-            ions = np.linspace(minx, maxx, len(pd))
-            yield Scan(ions, pd, name=t)
-
-        f.close()
+                pool = ThreadPoolExecutor(max_workers=workers)
+                pool_map = pool.map
+            try:
+                for st in range(0, len(recs), _PROFILE_BATCH):
+                    batch = recs[st:st + _PROFILE_BATCH]
+                    raw = []
+                    for _, _, off, bc, _, _, _ in batch:
+                        f.seek(off)
+                        raw.append(f.read(bc))
+                    pds = pool_map(_decode_profile, [r[1] for r in batch],
+                                   raw, [r[4] for r in batch])
+                    for (t, _, _, _, _, minx, maxx), pd in zip(batch, pds):
+                        # TODO: probably not a good approximation?
+                        ions = np.linspace(minx, maxx, len(pd))
+                        yield Scan(ions, pd, name=t)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
 
     def mrm_trace(self, parent=None, daughter=None, tol=0.5, twin=None):
         # TODO: should override `trace` and then call parent's `trace` method
         # if name is not an mrm trace
-        if twin is None:
-            twin = (-np.inf, np.inf)
-
-        tme, ic = [], []
-        for t, off, bc, pc, minx, maxx, d_mz, p_mz, z in self._scan_iter([
-            'ScanTime', 'SpectrumOffset', 'ByteCount', 'PointCount',
-            'MinX', 'MaxX', 'BasePeakMZ', 'MzOfInterest', 'TIC'
-        ]):
-            if t < twin[0]:
-                continue
-            elif t > twin[1]:
-                break
-            if parent is not None:
-                if np.abs(parent - p_mz) > tol:
-                    continue
-            if daughter is not None:
-                if np.abs(daughter - d_mz) > tol:
-                    continue
-            tme.append(t)
-            ic.append(z)
-
-        return Trace(np.array(ic), np.array(tme),
+        tab = self._scan_table
+        mask = self._twin_mask(twin)
+        if parent is not None:
+            mask &= np.abs(parent - tab['MzOfInterest']) <= tol
+        if daughter is not None:
+            mask &= np.abs(daughter - tab['BasePeakMZ']) <= tol
+        tab = tab[mask]
+
+        return Trace(tab['TIC'], tab['ScanTime'],
                      name=str(str(parent) + '→' + str(daughter)))
+
+
+# number of scans read in from MSProfile.bin at once
+_PROFILE_BATCH = 256
+
+
+def _decode_profile(fmt, d, npts):
+    """
+    Decodes one spectrum from a MassHunter MSProfile.bin; the points
+    follow two doubles at the start of the record.
+    """
+    if fmt == 1:
+        # this record is a raw deflate stream (i.e. gzipped data
+        # without the gzip header); any trailer is ignored
+        d = zlib.decompressobj(-zlib.MAX_WBITS).decompress(d)
+        dtype = '<i4'
+    elif fmt == 2:
+        dtype = '<f4'
+    else:
+        raise NotImplementedError('Unknown Agilent MH Scan format')
+    pd = np.frombuffer(d, dtype=dtype, count=npts, offset=16)
+    return pd.astype(int if fmt == 1 else float)
+
+
+# numpy equivalents of the simple types used in MassHunter's *.xsd files
+_XSD_TYPES = {'xs:int': '<i4', 'xs:long': '<i8', 'xs:short': '<i2',
+              'xs:byte': 'i1', 'xs:double': '<f8', 'xs:float': '<f4'}
+
+
+@cache(maxsize=8)
+def _xsd_dtype(xsd_file, rec_name):
+    """
+    Converts a record type in a MassHunter *.xsd schema into a (flat)
+    numpy structured dtype; nested record types are expanded in place.
+    """
+    r = ElementTree.parse(xsd_file).getroot()
+    rfrmt = {}
+    for n in r:
+        rfrmt[n.get('name')] = [(sn.get('name'), sn.get('type'))
+                                for sn in list(n)[0]]
+
+    names, formats, offsets = [], [], []
+
+    def resolve(recname, off):
+        for sname, stype in rfrmt[recname]:
+            if stype in _XSD_TYPES:
+                # if a name is repeated (in a nested record), the first
+                # one is the one that's used
+                if sname not in names:
+                    names.append(sname)
+                    formats.append(_XSD_TYPES[stype])
+                    offsets.append(off)
+                off += np.dtype(_XSD_TYPES[stype]).itemsize
+            else:
+                off = resolve(stype, off)
+        return off
+
+    size = resolve(rec_name, 0)
+    return np.dtype({'names': names, 'formats': formats,
+                     'offsets': offsets, 'itemsize': size})
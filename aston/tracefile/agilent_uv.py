@@ -5,7 +5,7 @@ from datetime import datetime
 import numpy as np
 from aston.cache import cache
 from aston.trace import Chromatogram
-from aston.tracefile import TraceFile
+from aston.tracefile import TraceFile, disk_cache
 
 
 def string_read(f):
@@ -23,11 +23,231 @@ def string_read(f):
     return out.replace('\x00', '')
 
 
+def delta_decode(buf, starts, ends, counts, order='<', join=False):
+    """
+    Decodes several of Agilent's delta-compressed streams at once.
+
+    Each stream is a run of int16 differences from the previous value
+    (starting from zero), except that a -32768 marks that the next
+    four bytes are an absolute int32 value to restart from.
+
+    Parameters
+    ----------
+    buf : np.ndarray
+        uint8 array of the raw file contents
+    starts, ends : np.ndarray
+        byte offsets bounding each stream in buf
+    counts : np.ndarray
+        number of values to decode out of each stream
+    order : {'<', '>'}
+        byte order of the stream
+    join : bool, optional
+        if True, the streams are consecutive chunks of one stream and
+        values carry over from the end of one chunk to the next
+
+    Returns
+    -------
+    np.ndarray
+        int64 array of every stream's values, one stream after another
+    """
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    counts = np.asarray(counts)
+    nwords = np.maximum((ends - starts) // 2, 0)
+    wst = np.zeros(len(starts) + 1, dtype=int)
+    np.cumsum(nwords, out=wst[1:])
+
+    # pull out every word of every stream into one array
+    pos = np.repeat(starts - 2 * wst[:-1], nwords) + 2 * np.arange(wst[-1])
+    if order == '<':
+        lo, hi = buf[pos], buf[pos + 1]
+    else:
+        hi, lo = buf[pos], buf[pos + 1]
+    words = (lo.astype(np.uint16) | (hi.astype(np.uint16) << 8)).view(np.int16)
+    strm = np.repeat(np.arange(len(starts)), nwords)
+
+    esc = _find_escapes(words, strm)
+    w1 = words[esc + 1].astype(np.int64)
+    w2 = words[esc + 2].astype(np.int64)
+    if order == '<':
+        absval = (w2 << 16) | (w1 & 0xFFFF)
+    else:
+        absval = (w1 << 16) | (w2 & 0xFFFF)
+
+    # remove the int32s so there's one "token" for every value
+    mask = np.ones(len(words), dtype=bool)
+    mask[esc + 1] = False
+    mask[esc + 2] = False
+    toks = words[mask].astype(np.int64)
+    tstrm = strm[mask]
+    tesc = esc - 2 * np.arange(len(esc))
+    ntoks = np.bincount(tstrm, minlength=len(starts))
+    tst = np.zeros(len(starts) + 1, dtype=int)
+    np.cumsum(ntoks, out=tst[1:])
+
+    # cumulatively sum the deltas, resetting the sum at the start of
+    # every stream (unless joined) and at every escape
+    delts = toks.copy()
+    delts[tesc] = 0
+    csum = np.cumsum(delts)
+    base = np.zeros(len(toks), dtype=np.int64)
+    resets = tst[:-1][ntoks > 0]
+    if join:
+        resets = resets[:1]
+    base[resets] = toks[resets] - csum[resets]
+    base[tesc] = absval - csum[tesc]
+    is_reset = np.zeros(len(toks), dtype=bool)
+    is_reset[resets] = True
+    is_reset[tesc] = True
+    last = np.maximum.accumulate(np.where(is_reset, np.arange(len(toks)), 0))
+    vals = csum + base[last]
+
+    # only keep as many values as were asked for from each stream
+    keep = np.arange(len(toks)) - tst[tstrm] < counts[tstrm]
+    return vals[keep]
+
+
+def _find_escapes(words, strm):
+    """
+    Returns the locations of the -32768 escapes in an array of int16
+    words, where strm labels the stream each word belongs to.
+    """
+    # find the escapes, dropping any whose int32 would run off the end
+    # of the stream (these can only be in the padding after a stream)
+    esc = np.flatnonzero(words == -32768)
+    esc = esc[esc + 2 < len(words)]
+    esc = esc[strm[esc + 2] == strm[esc]]
+    # the int32 after an escape can look like an escape too; these are
+    # rare enough that we can just walk through them in order
+    valid = np.ones(len(esc), dtype=bool)
+    for i in np.flatnonzero(np.diff(esc) <= 2) + 1:
+        j = i - 1
+        while j >= 0 and esc[i] - esc[j] <= 2:
+            if valid[j] and strm[esc[j]] == strm[esc[i]]:
+                valid[i] = False
+                break
+            j -= 1
+    return esc[valid]
+
+
+def read_ch_records(buf, pos, stop_on_empty=False):
+    """
+    Finds the records in the data section of a *.CH file. Each record
+    is a flag byte (0x10?) and a count of the big-endian, delta-compressed
+    values which follow it; the section ends with a (0, 0) header.
+
+    Returns the start, end and number of values of every record, ready
+    to be handed to delta_decode.
+    """
+    # every place in the file that could be an escape (-32768)
+    cands = np.flatnonzero((buf[:-1] == 0x80) & (buf[1:] == 0)).tolist()
+    ci = 0
+
+    starts, ends, counts = [], [], []
+    while pos + 2 <= len(buf):
+        flag, n = int(buf[pos]), int(buf[pos + 1])
+        if n == 0 and (flag == 0 or stop_on_empty):
+            break
+        pos += 2
+        # each escaped value takes up four extra bytes, so we need
+        # to know how many escapes there are to find the next record
+        end, esc_end = pos + 2 * n, pos
+        while ci < len(cands) and cands[ci] < pos:
+            ci += 1
+        while ci < len(cands) and cands[ci] < end:
+            c = cands[ci]
+            if (c - pos) % 2 == 0 and c >= esc_end:
+                end += 4
+                esc_end = c + 6
+            ci += 1
+        starts.append(pos)
+        ends.append(end)
+        counts.append(n)
+        pos = end
+    return (np.array(starts, dtype=int), np.array(ends, dtype=int),
+            np.array(counts, dtype=int))
+
+
+def read_dad_scans(buf, npos, nscans, lead_value=False):
+    """
+    Decodes all of the spectra in a Chemstation DAD *.UV file.
+
+    Parameters
+    ----------
+    buf : np.ndarray
+        uint8 array of the raw file contents
+    npos : int
+        byte offset of the first scan
+    nscans : int
+        number of scans in the file
+    lead_value : bool, optional
+        if True, each scan's deltas are preceded by an int16 starting
+        value (as in older, 0233, files)
+
+    Returns
+    -------
+    tuple
+        times (in minutes), wavelengths (in nm) and a dense array
+        of the absorbances with one row per scan
+    """
+    # hop through the scans to find where each one starts
+    offs = np.empty(nscans, dtype=int)
+    for i in range(nscans):
+        offs[i] = npos
+        npos += int(buf[npos]) | int(buf[npos + 1]) << 8
+
+    # read all the scan headers at once
+    hdr_dtype = np.dtype([('len', '<u2'), ('time', '<u4'),
+                          ('nm_srt', '<u2'), ('nm_end', '<u2'),
+                          ('nm_stp', '<u2')])
+    hdr_locs = offs[:, np.newaxis] + np.arange(hdr_dtype.itemsize)
+    hdrs = buf[hdr_locs].view(hdr_dtype)[:, 0]
+    srt = hdrs['nm_srt'].astype(int)
+    stp = hdrs['nm_stp'].astype(int)
+    n_wvs = np.maximum(-(-(hdrs['nm_end'] - srt) // stp), 0)
+
+    # the wavelength data starts after 20 bytes of header
+    vst = np.zeros(nscans + 1, dtype=int)
+    if lead_value:
+        # the starting value is just the first "delta" from zero, but
+        # it's replaced by the first real value so it's then dropped
+        np.cumsum(n_wvs + 1, out=vst[1:])
+        vals = delta_decode(buf, offs + 20, offs + hdrs['len'], n_wvs + 1)
+        vals = np.delete(vals, vst[:-1])
+    else:
+        vals = delta_decode(buf, offs + 20, offs + hdrs['len'], n_wvs)
+
+    # place each value into the right wavelength column
+    np.cumsum(n_wvs, out=vst[1:])
+    rows = np.repeat(np.arange(nscans), n_wvs)
+    raw_wvs = srt[rows] + stp[rows] * (np.arange(vst[-1]) - vst[rows])
+    wv_rngs = np.unique(np.vstack([srt, hdrs['nm_end'], stp]), axis=1)
+    wvs = np.unique(np.hstack([np.arange(*r) for r in wv_rngs.T]))
+    cols = np.searchsorted(wvs, raw_wvs)
+
+    ndata = np.zeros((nscans, len(wvs)))
+    ndata[rows, cols] = vals
+    times = hdrs['time'].astype(float)
+    return times / 60000., wvs / 20., ndata / 2000.
+
+
+def _ch_files(filename):
+    """
+    All of the *.CH channel files next to filename.
+    """
+    foldname = os.path.dirname(filename)
+    return [os.path.join(foldname, i) for i in os.listdir(foldname)
+            if i[-3:].upper() == '.CH']
+
+
 class AgilentMWD(TraceFile):
     mime = 'application/vnd-agilent-chemstation-mwd'
     traces = ['#uv']
 
+    def _cache_deps(self):
+        return _ch_files(self.filename)
+
     @property
+    @disk_cache
     def data(self):
         print(self.filename)
         # Because the spectra are stored in several files in the same
@@ -77,27 +297,13 @@ class AgilentMWD(TraceFile):
         f.seek(0x284)
         del_ab = struct.unpack('>d', f.read(8))[0]
 
-        data = np.array([])
-
-        f.seek(0x401)
-        loc = 0
-        while True:
-            rec_len = struct.unpack('>B', f.read(1))[0]
-            if rec_len == 0:
-                break
-            data = np.append(data, np.empty(rec_len))
-            for _ in range(rec_len):
-                inp = struct.unpack('>h', f.read(2))[0]
-                if inp == -32768:
-                    inp = struct.unpack('>i', f.read(4))[0]
-                    data[loc] = del_ab * inp
-                elif loc == 0:
-                    data[loc] = del_ab * inp
-                else:
-                    data[loc] = data[loc - 1] + del_ab * inp
-                loc += 1
-            f.read(1)  # this value is always 0x10?
+        f.seek(0)
+        buf = np.fromfile(f, dtype=np.uint8)
         f.close()
+
+        # records start at 0x400 (and the 0x10 there)
+        recs = read_ch_records(buf, 0x400, stop_on_empty=True)
+        data = del_ab * delta_decode(buf, *recs, order='>', join=True)
         return wv, data
 
     @property
@@ -128,7 +334,11 @@ class AgilentMWD2(TraceFile):
     mime = 'application/vnd-agilent-chemstation-mwd2'
     traces = ['#uv']
 
+    def _cache_deps(self):
+        return _ch_files(self.filename)
+
     @property
+    @disk_cache
     def data(self):
         # Because the spectra are stored in several files in the same
         # directory, we need to loop through them and return them together.
@@ -169,24 +379,13 @@ class AgilentMWD2(TraceFile):
         f.seek(0x127C)
         del_ab = struct.unpack('>d', f.read(8))[0]
 
-        data = []
-
-        f.seek(0x1800)
-        while True:
-            x, nrecs = struct.unpack('>BB', f.read(2))
-            if x == 0 and nrecs == 0:
-                break
-            for _ in range(nrecs):
-                inp = struct.unpack('>h', f.read(2))[0]
-                if inp == -32768:
-                    inp = struct.unpack('>i', f.read(4))[0]
-                    data.append(del_ab * inp)
-                elif len(data) == 0:
-                    data.append(del_ab * inp)
-                else:
-                    data.append(data[-1] + del_ab * inp)
+        f.seek(0)
+        buf = np.fromfile(f, dtype=np.uint8)
         f.close()
-        return wv, np.array(data)
+
+        recs = read_ch_records(buf, 0x1800)
+        data = del_ab * delta_decode(buf, *recs, order='>', join=True)
+        return wv, data
 
     def _get_str(self, f, off):
         """
@@ -222,45 +421,70 @@ class AgilentDAD(TraceFile):
     mime = 'application/vnd-agilent-masshunter-dad'
     traces = ['#uv']
 
-    # header data in DAD1.sd
-    # 80 byte repetition
-    # offset = 0xA4, format = 'IIfIfffQIIdddd'
-    #  750 entries
-    # f.seek(0xA4); struct.unpack('<IddffIQIIdddd', f.read(80))
+    def _cache_deps(self):
+        return [self.filename[:-3] + '.sd', self.filename[:-3] + '.sp']
 
     # time series in DAD1.sg
     # all doubles, starts at 0x44
     # 750x 54 double entries
     @property
+    @disk_cache
     def data(self):
-        fhead = open(self.filename[:-3] + '.sd', 'rb')
-        fdata = open(self.filename[:-3] + '.sp', 'rb')
-
-        fhead.seek(0x50)
-        nscans = struct.unpack('Q', fhead.read(8))[0]
-        fhead.seek(0xA4)
-
-        ions = []
-        for scn in range(nscans):
-            t = struct.unpack('<IdddIQIIdddd', fhead.read(80))
-
-            npts = t[7]
-            if scn == 0:
-                # TODO: this will fail if the wavelengths collected
-                # change through the run.
-                data = np.zeros((nscans, npts))
-                times = np.zeros((nscans))
-                ions = [t[8] + x * t[3] for x in range(npts)]
-
-            times[scn] = t[1]
-
-            fdata.seek(t[5] + 16)
-            # TODO: use np.fromfile?
-            data[scn] = struct.unpack('<' + npts * 'd', fdata.read(npts * 8))
-        return Chromatogram(data, times, ions)
-
-        fhead.close()
-        fdata.close()
+        with open(self.filename[:-3] + '.sd', 'rb') as f:
+            f.seek(0x50)
+            nscans = struct.unpack('Q', f.read(8))[0]
+            f.seek(0xA4)
+            hdrs = np.fromfile(f, dtype=_DAD_SD_DTYPE, count=nscans)
+        if len(hdrs) == 0:
+            return Chromatogram()
+        times = hdrs['time'].copy()
+
+        # each spectrum is a run of doubles 16 bytes into its record
+        sp = np.memmap(self.filename[:-3] + '.sp', dtype=np.uint8, mode='c')
+        offs = hdrs['offset'].astype(int) + 16
+        npts = hdrs['npts'].astype(int)
+        fixed_wvs = (np.all(npts == npts[0]) and
+                     np.all(hdrs['wv_srt'] == hdrs['wv_srt'][0]) and
+                     np.all(hdrs['wv_stp'] == hdrs['wv_stp'][0]))
+        if fixed_wvs and (len(offs) == 1 or
+                          np.all(np.diff(offs) == offs[1] - offs[0])):
+            # the spectra are evenly spaced through the file, so they
+            # can be read in place as one (strided) array
+            stride = offs[1] - offs[0] if len(offs) > 1 else 8 * npts[0]
+            data = np.ndarray((len(hdrs), npts[0]), dtype='<f8', buffer=sp,
+                              offset=offs[0], strides=(stride, 8))
+            wvs = hdrs['wv_srt'][0] + np.arange(npts[0]) * hdrs['wv_stp'][0]
+            return Chromatogram(data, times, wvs.tolist())
+
+        # otherwise, gather each spectrum into the columns
+        # for whichever wavelengths it has
+        rowst = np.zeros(len(hdrs) + 1, dtype=int)
+        np.cumsum(npts, out=rowst[1:])
+        rows = np.repeat(np.arange(len(hdrs)), npts)
+        pt_n = np.arange(rowst[-1]) - rowst[rows]
+        raw_wvs = hdrs['wv_srt'][rows] + pt_n * hdrs['wv_stp'][rows]
+        wvs, cols = np.unique(raw_wvs, return_inverse=True)
+        pos = (offs[rows] + 8 * pt_n)[:, np.newaxis] + np.arange(8)
+        data = np.zeros((len(hdrs), len(wvs)))
+        data[rows, cols] = sp[pos].view('<f8')[:, 0]
+        return Chromatogram(data, times, wvs.tolist())
+
+
+# header data in DAD1.sd (one 80 byte record per scan from 0xA4 on)
+_DAD_SD_DTYPE = np.dtype([
+    ('unk1', '<u4'),
+    ('time', '<f8'),
+    ('unk2', '<f8'),
+    ('wv_stp', '<f8'),
+    ('unk3', '<u4'),
+    ('offset', '<u8'),  # location of spectrum in DAD1.sp
+    ('unk4', '<u4'),
+    ('npts', '<u4'),
+    ('wv_srt', '<f8'),
+    ('unk5', '<f8'),
+    ('unk6', '<f8'),
+    ('unk7', '<f8'),
+])
 
 
 class AgilentCSDAD(TraceFile):
@@ -272,49 +496,25 @@ class AgilentCSDAD(TraceFile):
 
     @property
     @cache(maxsize=1)
+    @disk_cache
     def data(self):
         # TODO: the chromatograms this generates are not exactly the
         # same as the ones in the *.CH files. Maybe they need to be 0'd?
-        f = open(self.filename, 'rb')
+        with open(self.filename, 'rb') as f:
+            f.seek(0x146)
+            yunits = f.read(struct.unpack('>B', f.read(1))[0])
+            yunits = yunits.decode('ascii').strip()
 
-        f.seek(0x146)
-        yunits = f.read(struct.unpack('>B',
-                                      f.read(1))[0]).decode('ascii').strip()
+            f.seek(0x116)
+            nscans = struct.unpack('>i', f.read(4))[0]
 
-        f.seek(0x116)
-        nscans = struct.unpack('>i', f.read(4))[0]
+            f.seek(0)
+            buf = np.fromfile(f, dtype=np.uint8)
 
-        times = np.zeros(nscans)
-        data = nscans * [{}]
-        ions = []
-        npos = 0x202
-        for i in range(nscans):
-            f.seek(npos)
-            npos += struct.unpack('<H', f.read(2))[0]
-            times[i] = struct.unpack('<L', f.read(4))[0] / 60000.
-            nm_srt = struct.unpack('<H', f.read(2))[0] / 20.
-            nm_end = struct.unpack('<H', f.read(2))[0] / 20.
-            nm_stp = struct.unpack('<H', f.read(2))[0] / 20.
-            f.read(8)
-            s = {}
-            v = struct.unpack('<h', f.read(2))[0] / 2000.
-            s[nm_srt] = v
-            for wv in np.arange(nm_srt, nm_end, nm_stp):
-                ov = struct.unpack('<h', f.read(2))[0]
-                if ov == -32768:
-                    v = struct.unpack('<i', f.read(4))[0] / 2000.
-                else:
-                    v += ov / 2000.
-                s[wv] = v
-                if wv not in ions:
-                    ions.append(wv)
-            data[i] = s
-
-        ndata = np.zeros((nscans, len(ions)))
-        for i, d in zip(range(nscans), data):
-            for ion, abn in d.items():
-                ndata[i, ions.index(ion)] = abn
-        return Chromatogram(ndata, times, ions, yunits=yunits)
+        # the deltas in each scan follow an int16 starting value
+        times, wvs, ndata = read_dad_scans(buf, 0x202, nscans,
+                                           lead_value=True)
+        return Chromatogram(ndata, times, wvs, yunits=yunits)
 
     @property
     def info(self):
@@ -351,6 +551,7 @@ class AgilentCSDAD2(TraceFile):
 
     @property
     @cache(maxsize=1)
+    @disk_cache
     def data(self):
         f = open(self.filename, 'rb')
 
@@ -360,79 +561,12 @@ class AgilentCSDAD2(TraceFile):
         f.seek(0x116)
         nscans = struct.unpack('>i', f.read(4))[0]
 
-        # get all wavelengths and times
-        wvs = set()
-        times = np.empty(nscans)
-        npos = 0x1002
-        for i in range(nscans):
-            f.seek(npos)
-            npos += struct.unpack('<H', f.read(2))[0]
-            times[i] = struct.unpack('<L', f.read(4))[0]
-            nm_srt, nm_end, nm_stp = struct.unpack('<HHH', f.read(6))
-            n_wvs = np.arange(nm_srt, nm_end, nm_stp) / 20.
-            wvs.update(set(n_wvs).difference(wvs))
-        wvs = list(wvs)
-        max_index = wvs.index(max(wvs))  # index maximum wavelength
-        wv_index_map = [val for val in range(max_index + 1, len(wvs))]
-        wv_index_map.extend([val for val in range(0, max_index + 1)])
-
-        ndata = np.empty((nscans, len(wvs)), dtype="<i4")
-        npos = 0x1002
-
-        # try to speed up by preloading the function
-        unpack = struct.unpack
-        seek = f.seek
-        read = f.read
-        tell = f.tell
-
-        for i in range(nscans):
-            seek(npos)
-            dlen = unpack('<H', read(2))[0]
-            npos += dlen
-            seek(tell() + 4)  # skip time
-            seek(tell() + 6 + 8)  # skip wavelength description and extra
-
-            # OLD CODE
-            v = 0
-            pos = f.tell()
-            for ind in wv_index_map:
-                ov = unpack('<h', read(2))[0]
-                if ov == -32768:
-                    v = unpack('<i', read(4))[0]
-                else:
-                    v += ov
-                ndata[i, ind] = v
-            seek(pos)
-
-            #  WORKING ON A FASTER WAY TO READ ALL THIS DATA BELOW
-            #  read in all the data
-            # data = np.fromfile(f, dtype="<i2", count=int((dlen - 24) / 2))
-
-            #  if there are any records marked -32768, we need to reinterpret
-            #  parts of the array as i4's
-            # oob_idxs = np.where(data == -32768)[0]
-
-            #  locations of the cells to merge into 32-bit ints
-            # big_idxs = np.repeat(oob_idxs, 2) + \
-            #         np.tile([1, 2], oob_idxs.shape[0])
-            # big_data = data[big_idxs].view('<i4').copy()
-
-            #  remove the 32-bit cells, so the arrays the right size
-            # data = np.delete(data, big_idxs).astype("<i4")
-
-            #  set the marker cells to the right values
-            # oob_idxs = np.where(data == -32768)[0]
-            # data[oob_idxs] = big_data
-
-            #  compute cumulative sums for each chunk
-            # pidx = 0
-            # if data.shape[0] != ndata.shape[1]:
-            #     print(big_data)
-            # for idx in np.hstack([oob_idxs, data.shape[0]]):
-            #     ndata[i, pidx:idx] = np.cumsum(data[pidx:idx])
-            #     pidx = idx
+        f.seek(0)
+        buf = np.fromfile(f, dtype=np.uint8)
         f.close()
-        return Chromatogram(ndata / 2000., times / 60000., wvs, yunits=yunits)
+
+        times, wvs, ndata = read_dad_scans(buf, 0x1002, nscans)
+        return Chromatogram(ndata, times, wvs, yunits=yunits)
 
     @property
     def info(self):
@@ -1,89 +1,68 @@
-import struct
 import numpy as np
 import scipy.sparse
-from aston.trace import Chromatogram, Trace
-from aston.tracefile import TraceFile
+from aston.trace import Chromatogram
+from aston.tracefile import TraceFile, disk_cache
 
 
 class BrukerMSMS(TraceFile):
     mime = 'application/vnd-bruker-msms'
     traces = ['#ms']
 
-    # def _getTotalTrace(self):
-    #     pass
-
     @property
+    @disk_cache
     def data(self):
-        # convenience function for reading in data
-        def rd(f, st):
-            return struct.unpack(st, f.read(struct.calcsize(st)))
-
-        # open the file
-        f = open(self.filename, 'rb')
-
-        nscans = rd(f, 'ii')[1]
+        return self.binned_data()
+
+    def binned_data(self, tol=None):
+        """
+        Reads in the MS/MS data.
+
+        Parameters
+        ----------
+        tol : float, optional
+            If set, m/z values that are within this distance of their
+            neighbors are merged into one column (named with their mean);
+            otherwise every distinct m/z gets its own column.
+
+        Returns
+        -------
+        Chromatogram
+        """
+        words = np.memmap(self.filename, dtype='<i4', mode='r')
+        nscans = int(words[1])
         if nscans == 0:
-            self.data = Trace(np.array([]), np.array([]), [])
-            return
-        times = np.array(rd(f, nscans * 'd')) / 60.0
-        f.seek(f.tell() + 4)  # number of scans again
-
-        # set up the array of column indices
-        indptr = np.empty(nscans + 1, dtype=int)
-        indptr[0] = 0
-
-        # figure out the total number of points
-        dpos = f.tell()
-        tot_pts = 0
-        for scn in range(nscans):
-            npts = rd(f, 'i')[0]
-            # rd(f, npts * 'f' + 'i' + n_pts * 'f')
-            f.seek(f.tell() + 8 * npts + 4)
-            tot_pts += npts
-            indptr[scn + 1] = tot_pts
-        f.seek(dpos)
-
-        ions = []
-        i_lkup = {}
-        idxs = np.empty(tot_pts, dtype=int)
-        vals = np.empty(tot_pts, dtype=float)
+            return Chromatogram()
+        times = words[2:2 + 2 * nscans].view('<f8') / 60.0
 
+        # each scan is the number of points, the m/zs, the number
+        # of points again and then the abundances
+        pos = 3 + 2 * nscans
+        offs = np.empty(nscans, dtype=int)
         for scn in range(nscans):
-            npts = rd(f, 'i')[0]
-            rd_ions = rd(f, npts * 'f')
-            f.seek(f.tell() + 4)  # number of points again
-            abun = rd(f, npts * 'f')
-
-            nions = set([int(i) for i in rd_ions if int(i) not in i_lkup])
-            i_lkup.update(dict((ion, i + len(ions) - 1)
-                               for i, ion in enumerate(nions)))
-            ions += nions
-
-            idxs[indptr[scn]:indptr[scn + 1]] = \
-                [i_lkup[int(i)] for i in rd_ions]
-            vals[indptr[scn]:indptr[scn + 1]] = \
-                abun
-
-        idxs += 1
+            offs[scn] = pos
+            pos += 2 + 2 * int(words[pos])
+        npts = words[offs].astype(int)
+        indptr = np.zeros(nscans + 1, dtype=int)
+        indptr[1:] = np.cumsum(npts)
+        pt_pos = np.arange(indptr[-1]) + np.repeat(offs + 1 - indptr[:-1],
+                                                   npts)
+        floats = words.view('<f4')
+        mzs = floats[pt_pos].astype(float)
+        vals = floats[pt_pos + np.repeat(npts + 1, npts)].astype(float)
+
+        ions, idxs = np.unique(mzs, return_inverse=True)
+        if tol is not None and len(ions) > 0:
+            # start a new bin wherever there's a gap bigger than tol
+            bins = np.zeros(len(ions), dtype=int)
+            bins[1:] = np.cumsum(np.diff(ions) > tol)
+            ions = np.bincount(bins, ions) / np.bincount(bins)
+            idxs = bins[idxs]
+
         data = scipy.sparse.csr_matrix((vals, idxs, indptr),
-                                       shape=(nscans, len(ions)), dtype=float)
+                                       shape=(nscans, len(ions)))
+        data.sum_duplicates()
         return Chromatogram(data, times, ions)
 
-        # self.data = np.zeros((recs, 2))
-        # times = rd(f, nscans * 'd')
-        # self.data[:, 0] = np.array(times) / 60
-        # ions = set()
-        # rd(f, 'i')  # number of data points again
-        # for i in range(nscans):
-        #     n_pts = rd(f, 'i')[0]
-        #     ions.update(rd(f, n_pts * 'f'))
-        #     rd(f, 'i')  # number of pts in spectra again
-        #     abun = rd(f, n_pts * 'f')
-        #     #self.data[i, 0] = times[i] / 60
-        #     self.data[i, 1] = sum(abun)
-        # f.close()
-        # self.ions = [1]
-
 
 class BrukerBAF(TraceFile):
     mime = 'application/vnd-bruker-baf'
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 import struct
 import numpy as np
+import scipy.sparse
 from aston.trace import Chromatogram
-from aston.tracefile import TraceFile, find_offset
+from aston.tracefile import TraceFile, disk_cache, find_offset
 
 
 class InficonHapsite(TraceFile):
@@ -51,11 +52,10 @@ class InficonHapsite(TraceFile):
         f.seek(outside_pos)
 
     @property
+    @disk_cache
     def data(self):
         # TODO: handle skip mass ranges
         with open(self.filename, 'rb') as f:
-            # read in the time segments/mz ranges for the run
-
             # read in the data itself
             doff = find_offset(f, 4 * b'\xff' + 'HapsScan'.encode('ascii'))
             if doff is None:
@@ -64,38 +64,95 @@ class InficonHapsite(TraceFile):
             data_end = doff + struct.unpack('<I', f.read(4))[0] + 55
 
             f.seek(doff + 56)
-            times, abns, mzs = [], [], []
-            cur_seg = None
+            buf = f.read()
+            hdrs = _read_scan_headers(buf, data_end - doff - 56)
+
+            # read in the time segments/mz ranges for the run; the mzs
+            # change every time the segment number in the scans does
+            new_seg = np.ones(len(hdrs), dtype=bool)
+            new_seg[1:] = hdrs['seg'][1:] != hdrs['seg'][:-1]
             mz_reader = self._ions(f)
-            while f.tell() <= data_end:
-                # record info looks like a standard format
-                n, t, _, recs, _, seg = struct.unpack('<IiHHHH', f.read(16))
-                if cur_seg != seg:
-                    # if we've switched segments, update the list of mzs
-                    try:
-                        cur_mzs = next(mz_reader)
-                    except StopIteration:
-                        break
-                    mzs += set(cur_mzs).difference(mzs)
-                    mz_idx = [mzs.index(i) for i in cur_mzs]
-                cur_seg = seg
-
-                # just add the new time in
-                times.append(t)
-
-                # read the list of abundances
-                cur_abns = struct.unpack('<' + 'f' * recs, f.read(4 * recs))
-                # convert this list into an array that matches up with
-                # whatever mzs we currently have
-                empty_row = np.zeros(len(mzs))
-                empty_row[mz_idx] = cur_abns
-                # add that row into the list
-                abns.append(empty_row)
+            seg_mzs = []
+            for st in np.flatnonzero(new_seg):
+                try:
+                    seg_mzs.append(np.array(next(mz_reader), dtype=float))
+                except StopIteration:
+                    hdrs, new_seg = hdrs[:st], new_seg[:st]
+                    break
+
+        # one flat table of the mzs in every segment, so each abundance
+        # can be looked up with a single index
+        seg_len = np.array([len(m) for m in seg_mzs], dtype=int)
+        seg_base = np.cumsum(seg_len) - seg_len
+        seg_mzs = np.concatenate([np.array([])] + seg_mzs)
+        mzs = np.unique(seg_mzs)
+        seg_cols = np.searchsorted(mzs, seg_mzs)
+        # if an mz is in a segment twice, only keep the last abundance
+        seg_keep = np.zeros(len(seg_mzs), dtype=bool)
+        for st, n in zip(seg_base, seg_len):
+            _, fst = np.unique(seg_mzs[st:st + n][::-1], return_index=True)
+            seg_keep[st + n - 1 - fst] = True
 
+        # which scan each abundance is in and its position in that scan
+        recs = hdrs['recs'].astype(int)
+        rows = np.repeat(np.arange(len(hdrs)), recs)
+        pt_n = np.arange(len(rows)) - np.repeat(np.cumsum(recs) - recs, recs)
+        pt_seg = (np.cumsum(new_seg) - 1)[rows]
+        keep = pt_n < seg_len[pt_seg]
+        flat_i = seg_base[pt_seg] + pt_n
+        keep[keep] = seg_keep[flat_i[keep]]
+        rows, pt_n, flat_i = rows[keep], pt_n[keep], flat_i[keep]
+
+        pos = (hdrs['offset'][rows] + 16) // 4 + pt_n
+        abns = np.frombuffer(buf, dtype='<f4', count=len(buf) // 4)[pos]
+        # rows are already in order and hold no duplicate columns
+        indptr = np.zeros(len(hdrs) + 1, dtype=int)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(hdrs)))
+        data = scipy.sparse.csr_matrix((abns.astype(float),
+                                        seg_cols[flat_i], indptr),
+                                       shape=(len(hdrs), len(mzs)))
+        data.sort_indices()
         # convert the time from milliseconds to minutes
-        times = np.array(times, dtype=float) / 60000
-        # create the data array and populate it
-        data = np.zeros((len(times), len(mzs)))
-        for i, r in enumerate(abns):
-            data[i, 0:len(r)] = r
-        return Chromatogram(data, times, mzs)
+        times = hdrs['time'].astype(float) / 60000
+        return Chromatogram(data, times, mzs.tolist())
+
+
+def _read_scan_headers(buf, last_off):
+    """
+    Finds the header of every scan record in a Hapsite data section.
+
+    Each header is 16 bytes and is followed by `recs` 4-byte floats,
+    so the headers have to be found by hopping from one to the next.
+
+    Parameters
+    ----------
+    buf : bytes
+        The data section, starting with the first record.
+    last_off : int
+        Offset of the last place a record could start in buf.
+
+    Returns
+    -------
+    np.ndarray
+        Record array with the fields offset, time, recs and seg.
+    """
+    offs = []
+    pos = 0
+    while pos <= last_off and pos + 16 <= len(buf):
+        offs.append(pos)
+        pos += 16 + 4 * struct.unpack_from('<H', buf, pos + 10)[0]
+    offs = np.array(offs, dtype=int)
+
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    hdrs = raw[offs[:, None] + np.arange(16)].view(_SCAN_DTYPE)[:, 0]
+    out = np.empty(len(offs), dtype=[('offset', int), ('time', '<i4'),
+                                     ('recs', '<u2'), ('seg', '<u2')])
+    out['offset'] = offs
+    for fld in ['time', 'recs', 'seg']:
+        out[fld] = hdrs[fld]
+    return out
+
+
+# header in front of every scan record
+_SCAN_DTYPE = np.dtype([('n', '<u4'), ('time', '<i4'), ('unk1', '<u2'),
+                        ('recs', '<u2'), ('unk2', '<u2'), ('seg', '<u2')])
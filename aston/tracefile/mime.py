@@ -1,10 +1,7 @@
 import binascii
-from glob import glob
-import inspect
 from importlib import import_module
 import mimetypes
 import os
-import os.path as op
 
 from aston.cache import cache
 
@@ -63,7 +60,65 @@ application/vnd-waters-autospec  idx          *
 """
 
 
-def get_mimetype(filename, magic_all):
+# the class that reads each mimetype; these are only imported
+# once a file of that type is actually opened
+readers = {
+    'text/csv': 'aston.tracefile.other_files:CSVFile',
+    'application/mzxml': 'aston.tracefile.mzml:MzXML',
+    'application/mzml': 'aston.tracefile.mzml:MzML',
+    'application/netcdf': 'aston.tracefile.netcdf:NetCDF',
+    'application/vnd-agilent-chemstation-pump':
+        'aston.tracefile.agilent_extra_cs:AgilentCSPump',
+    'application/vnd-agilent-chemstation-fraction':
+        'aston.tracefile.agilent_extra_cs:AgilentCSFraction',
+    'application/vnd-agilent-chemstation-flowinject':
+        'aston.tracefile.agilent_extra_cs:AgilentCSFlowInject',
+    'application/vnd-agilent-chemstation-lcstat':
+        'aston.tracefile.agilent_extra_cs:AgilentCSLC',
+    'application/vnd-agilent-masshunter-pump':
+        'aston.tracefile.agilent_extra_mh:AgilentMHPump',
+    'application/vnd-agilent-masshunter-temp':
+        'aston.tracefile.agilent_extra_mh:AgilentMHTemp',
+    'application/vnd-agilent-masshunter-acqmethod':
+        'aston.tracefile.agilent_extra_mh:AgilentMHAcqMethod',
+    'application/vnd-agilent-masshunter-sampleinfo':
+        'aston.tracefile.agilent_extra_mh:AgilentMHSampleInfo',
+    'application/vnd-agilent-masshunter-msmsscan':
+        'aston.tracefile.agilent_ms:AgilentMSMSScan',
+    'application/vnd-agilent-masshunter-dad':
+        'aston.tracefile.agilent_uv:AgilentDAD',
+    'application/vnd-agilent-chemstation-fid':
+        'aston.tracefile.agilent_fid:AgilentFID',
+    'application/vnd-agilent-chemstation-fid2':
+        'aston.tracefile.agilent_fid:AgilentFID2',
+    'application/vnd-agilent-chemstation-ms':
+        'aston.tracefile.agilent_ms:AgilentMS',
+    'application/vnd-agilent-chemstation-mwd':
+        'aston.tracefile.agilent_uv:AgilentMWD',
+    'application/vnd-agilent-chemstation-mwd2':
+        'aston.tracefile.agilent_uv:AgilentMWD2',
+    'application/vnd-agilent-chemstation-dad':
+        'aston.tracefile.agilent_uv:AgilentCSDAD',
+    'application/vnd-agilent-chemstation-dad2':
+        'aston.tracefile.agilent_uv:AgilentCSDAD2',
+    'application/vnd-bruker-msms': 'aston.tracefile.bruker:BrukerMSMS',
+    'application/vnd-bruker-baf': 'aston.tracefile.bruker:BrukerBAF',
+    'application/vnd-inficon-hapsite':
+        'aston.tracefile.inficon:InficonHapsite',
+    'application/vnd-thermo-cf': 'aston.tracefile.thermo:ThermoCF',
+    'application/vnd-thermo-dxf': 'aston.tracefile.thermo:ThermoDXF',
+    'application/vnd-thermo-raw': 'aston.tracefile.thermo:ThermoRAW',
+    'application/vnd-waters-autospec':
+        'aston.tracefile.waters:WatersAutospec',
+}
+
+
+@cache(maxsize=1)
+def _lookup_tables():
+    """
+    Parses the mimes table into lookups of magic numbers and
+    file extensions to mimetypes.
+    """
     ft_magic = {}
     ft_ext = {}
     for line in mimes.strip('\n').split('\n'):
@@ -75,6 +130,11 @@ def get_mimetype(filename, magic_all):
         if ext != '*':
             for e in ext.split(','):
                 ft_ext[e] = mime
+    return ft_magic, ft_ext
+
+
+def get_mimetype(filename, magic_all):
+    ft_magic, ft_ext = _lookup_tables()
 
     # TODO: maybe do some kind of ranking?
     # need to allow multiple filetypes for common magic/extensions
@@ -91,23 +151,20 @@ def get_mimetype(filename, magic_all):
     return mimetypes.guess_type(filename)[0]
 
 
-@cache(maxsize=1)
+@cache(maxsize=None)
+def tfclass(mime):
+    """
+    Returns the class for reading files of a mimetype (importing
+    it if needed) or None if there isn't one.
+    """
+    if mime not in readers:
+        return None
+    mod_name, cls_name = readers[mime].split(':')
+    return getattr(import_module(mod_name), cls_name)
+
+
 def tfclasses():
     """
     A mapping of mimetypes to every class for reading data files.
     """
-    # automatically find any subclasses of TraceFile in the same
-    # directory as me
-    classes = {}
-    mydir = op.dirname(op.abspath(inspect.getfile(get_mimetype)))
-    tfcls = {"<class 'aston.tracefile.TraceFile'>",
-             "<class 'aston.tracefile.ScanListFile'>"}
-    for filename in glob(op.join(mydir, '*.py')):
-        name = op.splitext(op.basename(filename))[0]
-        module = import_module('aston.tracefile.' + name)
-        for clsname in dir(module):
-            cls = getattr(module, clsname)
-            if hasattr(cls, '__base__'):
-                if str(cls.__base__) in tfcls:
-                    classes[cls.mime] = cls
-    return classes
+    return {mime: tfclass(mime) for mime in readers}
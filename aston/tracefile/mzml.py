@@ -3,9 +3,11 @@ import zlib
 import base64
 from xml.etree import ElementTree as Et
 import numpy as np
+import scipy.sparse
 from aston import __version__
-from aston.trace import Trace
-from aston.tracefile import ScanListFile
+from aston.cache import cache
+from aston.trace import Chromatogram, Trace
+from aston.tracefile import ScanListFile, disk_cache
 from aston.spectra import Scan
 
 
@@ -19,39 +21,94 @@ def t_to_min(x):
                for i in range(3))
 
 
-# class mzXML(ScanListFile):
-class MzXML(object):
+class MzXML(ScanListFile):
     mime = 'application/mzxml'
     traces = ['#ms']
 
-    ns = {'m': 'http://sashimi.sourceforge.net/schema_revision/mzXML_2.1'}
+    def _scan_iter(self, twin=None):
+        """
+        Streams through the file, yielding every scan element in `twin`
+        along with its time and its peaks element. Elements are thrown
+        away as soon as they're read, so memory use stays constant.
+        """
+        if twin is None:
+            twin = (-np.inf, np.inf)
+        stack = []
+        for event, elem in Et.iterparse(self.filename, ('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+            stack.pop()
+            if elem.tag.endswith('peaks') and stack[-1].tag.endswith('scan'):
+                # MS2 scans are nested inside their parent MS1 scans, so
+                # we read each scan at the end of its peaks (before any
+                # child scans) to keep everything in file order
+                scn = stack[-1]
+                t = t_to_min(scn.get('retentionTime', 'PT0S'))
+                if t > twin[1]:
+                    break
+                if t >= twin[0]:
+                    yield scn, t, elem
+                elem.clear()
+            elif elem.tag.endswith('scan') and len(stack) > 0:
+                stack[-1].remove(elem)
+
+    @staticmethod
+    def _read_peaks(pks):
+        """
+        Decodes a peaks element into arrays of mzs and abundances.
+        """
+        dtype = {'32': '>f4', '64': '>f8'}.get(pks.get('precision'), '>f4')
+        rawdata = base64.b64decode(pks.text or '')
+        if pks.get('compressionType') == 'zlib':
+            rawdata = zlib.decompress(rawdata)
+        d = np.frombuffer(rawdata, dtype)
+        if pks.get('pairOrder', 'm/z-int') != 'm/z-int':
+            return d[1::2], d[::2]
+        return d[::2], d[1::2]
 
-    @property
-    def data(self):
-        # get all the scans under the root node
-        r = Et.parse(self.filename).getroot()
-        s = r.findall('*//m:scan', namespaces=self.ns)
-
-        for scn in s:
-            # scn.get('peaksCount')
-            # extract out the actual scan data
-            pks = scn.find('m:peaks', namespaces=self.ns)
-            dtype = {'32': '>f4', '64': '>f8'}.get(pks.get('precision'))
-            d = np.frombuffer(base64.b64decode(pks.text), dtype)
-            mz = d[::2]  # noqa
-            abn = d[1::2]  # noqa
-            # FIXME
+    def scans(self, twin=None):
+        for _, t, pks in self._scan_iter(twin):
+            mz, abn = self._read_peaks(pks)
+            yield Scan(mz, abn, name=t)
 
     def total_trace(self, twin=None):
-        # TODO: use twin
-        # TODO: only get the scans with totIonCurrent; if none found
-        # calculate from the data
+        # use the recorded totIonCurrents and only
+        # decode the scans that don't have one
+        times, tic = [], []
+        for scn, t, pks in self._scan_iter(twin):
+            times.append(t)
+            if scn.get('totIonCurrent') is not None:
+                tic.append(float(scn.get('totIonCurrent')))
+            else:
+                tic.append(self._read_peaks(pks)[1].sum())
+        return Trace(np.array(tic), np.array(times), name='TIC')
 
-        r = Et.parse(self.filename).getroot()
-        s = r.findall('*//m:scan', namespaces=self.ns)
-        d = np.array([float(i.get('totIonCurrent')) for i in s])
-        t = np.array([t_to_min(i.get('retentionTime')) for i in s])
-        return Trace(d, t, name='TIC')
+    @property
+    @cache(maxsize=1)
+    @disk_cache
+    def data(self):
+        """
+        A sparse Chromatogram of all of the MS1 scans in the file.
+        """
+        times, mzs, abns = [], [], []
+        for scn, t, pks in self._scan_iter():
+            if scn.get('msLevel', '1') != '1':
+                continue
+            mz, abn = self._read_peaks(pks)
+            times.append(t)
+            mzs.append(mz)
+            abns.append(abn)
+
+        if len(times) == 0:
+            return Chromatogram()
+        ions, cols = np.unique(np.hstack(mzs), return_inverse=True)
+        rowst = np.zeros(len(times) + 1, dtype=int)
+        np.cumsum([len(mz) for mz in mzs], out=rowst[1:])
+        data = scipy.sparse.csr_matrix((np.hstack(abns), cols, rowst),
+                                       shape=(len(times), len(ions)),
+                                       dtype=float)
+        return Chromatogram(data, np.array(times), ions)
 
 
 class MzML(ScanListFile):
@@ -60,135 +117,249 @@ class MzML(ScanListFile):
 
     ns = {'m': 'http://psi.hupo.org/ms/mzml'}
 
+    # accessions for the x-axis (mz, wavelength, ?) and y-axis arrays
+    x_accs = {'MS:1000514', 'MS:1000617', 'MS:1000786'}
+    y_accs = {'MS:1000515'}
+
+    def _tag(self, name):
+        return '{' + self.ns['m'] + '}' + name
+
+    def _iterparse(self, tag):
+        """
+        Streams through the file, yielding every `tag` element (spectrum
+        or chromatogram) once it's been read in. Spectra and chromatograms
+        are thrown away as soon as they've been read so memory use stays
+        constant no matter how large the file is.
+        """
+        big_tags = {self._tag('spectrum'), self._tag('chromatogram')}
+        pgl_tag = self._tag('referenceableParamGroupList')
+        stack = []
+        for event, elem in Et.iterparse(self.filename, ('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+            stack.pop()
+            if elem.tag == pgl_tag:
+                self._param_groups = self._read_param_groups(elem)
+            elif elem.tag in big_tags:
+                if elem.tag == self._tag(tag):
+                    yield elem
+                if len(stack) > 0:
+                    stack[-1].remove(elem)
+
+    def _read_param_groups(self, pgl):
+        """
+        Resolves all of the referenceableParamGroups into a dictionary
+        of group ids to lists of cvParams.
+        """
+        return {pg.get('id'): pg.findall('m:cvParam', namespaces=self.ns)
+                for pg in pgl.findall('m:referenceableParamGroup',
+                                      namespaces=self.ns)}
+
+    @property
+    def _index(self):
+        """
+        The byte offsets of every spectrum and chromatogram in the file
+        from the <indexList> at the end of an indexedmzML file (or None
+        if the file is not indexed), as lists of the ids and offsets
+        and a dictionary of each id's position in those.
+        """
+        if hasattr(self, '_idx'):
+            return self._idx
+        self._idx = None
+
+        with open(self.filename, 'rb') as f:
+            f.seek(0, 2)
+            f.seek(max(f.tell() - 1024, 0))
+            srch = re.search(br'<indexListOffset>\s*(\d+)\s*<', f.read())
+            if srch is None:
+                return None
+            f.seek(int(srch.group(1)))
+            lst = self._read_elem(f, 'indexList')
+
+        if lst is None:
+            return None
+        self._idx = {}
+        for idx in lst.findall('m:index', namespaces=self.ns):
+            offs = idx.findall('m:offset', namespaces=self.ns)
+            ids = [o.get('idRef') for o in offs]
+            self._idx[idx.get('name')] = (
+                ids, [int(o.text) for o in offs],
+                {i: n for n, i in reversed(list(enumerate(ids)))}
+            )
+        return self._idx
+
+    def _read_elem(self, f, tag, chunk_size=65536):
+        """
+        Reads in a single element starting at the current position
+        of `f` (e.g. one found through the index).
+        """
+        prefix = b'<' + tag.encode('ascii')
+        d = f.read(chunk_size)
+        if not d.lstrip().startswith(prefix):
+            return None
+        end = b'</' + tag.encode('ascii') + b'>'
+        # only search the newly read data (and enough of the data
+        # before it to catch an end tag split across two reads)
+        chunks, tail, n_read = [d], d, len(d)
+        end_pos = d.find(end)
+        while end_pos == -1:
+            nd = f.read(chunk_size)
+            if nd == b'':
+                return None
+            tail = tail[-len(end) + 1:] + nd
+            if end in tail:
+                end_pos = n_read + len(nd) - len(tail) + tail.index(end)
+            chunks.append(nd)
+            n_read += len(nd)
+        d = b''.join(chunks)[:end_pos + len(end)].lstrip()
+        # this fragment doesn't include the namespace declaration, so add it
+        d = prefix + b' xmlns="' + self.ns['m'].encode('ascii') + b'"' + \
+            d[len(prefix):]
+        return Et.fromstring(d)
+
+    def _elem_at(self, tag, key):
+        """
+        Finds a single spectrum or chromatogram by its position in the
+        file or by its id, seeking directly to it if the file is indexed.
+        """
+        idx = self._index
+        if idx is not None and tag in idx:
+            _, offs, pos = idx[tag]
+            i = pos.get(key) if isinstance(key, str) else key
+            if i is None or not 0 <= i < len(offs):
+                # not in the file (like below)
+                return None
+            self._load_param_groups()
+            with open(self.filename, 'rb') as f:
+                f.seek(offs[i])
+                elem = self._read_elem(f, tag)
+            if elem is not None:
+                return elem
+
+        for i, elem in enumerate(self._iterparse(tag)):
+            if key == i or key == elem.get('id'):
+                return elem
+
+    def _load_param_groups(self):
+        """
+        Makes sure the referenceableParamGroups (which are at the
+        start of the file) have been read in before any random access.
+        """
+        if hasattr(self, '_param_groups'):
+            return
+        self._param_groups = {}
+        pgl_tag = self._tag('referenceableParamGroupList')
+        for event, elem in Et.iterparse(self.filename, ('start', 'end')):
+            if event == 'end' and elem.tag == pgl_tag:
+                self._param_groups = self._read_param_groups(elem)
+                break
+            elif event == 'start' and elem.tag == self._tag('run'):
+                break
+
+    def _params(self, elem):
+        """
+        Returns a dictionary of the accessions of all the cvParams that
+        apply to `elem` (including any in referenced param groups).
+        """
+        groups = getattr(self, '_param_groups', {})
+        params = {p.get('accession'): p.get('value') for p in
+                  elem.findall('m:cvParam', namespaces=self.ns)}
+        for ref in elem.findall('m:referenceableParamGroupRef',
+                                namespaces=self.ns):
+            for p in groups.get(ref.get('ref'), []):
+                params.setdefault(p.get('accession'), p.get('value'))
+        return params
+
+    def _to_scan(self, s):
+        q = './/m:cvParam[@accession="MS:1000016"]'
+        time_elem = s.find(q, namespaces=self.ns)
+        if time_elem is None:
+            return None
+
+        x, y = None, None
+        for ba in s.iterfind('m:binaryDataArrayList/m:binaryDataArray',
+                             namespaces=self.ns):
+            accs = set(self._params(ba))
+            if x is None and not accs.isdisjoint(self.x_accs):
+                x = self.read_binary(ba)
+            elif y is None and not accs.isdisjoint(self.y_accs):
+                y = self.read_binary(ba)
+        if x is None or y is None:
+            return None
+        return Scan(x, y, name=float(time_elem.get('value')))
+
     def scans(self, twin=None):
         if twin is None:
             twin = (-np.inf, np.inf)
-        r = Et.parse(self.filename).getroot()
-        pgr = r.find('.//m:referenceableParamGroupList', namespaces=self.ns)
-
-        spectra = r.findall('*//m:spectrum', namespaces=self.ns)
-        for s in spectra:
-            q = './/m:cvParam[@accession="MS:1000016"]'
-            time_elem = s.find(q, namespaces=self.ns)
-            if time_elem is None:
+        for s in self._iterparse('spectrum'):
+            scn = self._to_scan(s)
+            if scn is None:
                 continue
-            time = time_elem.get('value')
-
-            # FIXME: won't find these properties if a paramGroupRef exists
-            for i in ['MS:1000514', 'MS:1000617', 'MS:1000786']:
-                q = './/m:cvParam[@accession="' + i + '"]/..'
-                x_elem = s.find(q, namespaces=self.ns)
-                if x_elem is not None:
-                    x = self.read_binary(x_elem, pgr)
-                    break
-            else:
-                # check paramGroupRef
-                q0 = './/m:referenceableParamGroupRef'
-                bin_arrs = s.findall(q0 + '/..', namespaces=self.ns)
-                for ba in bin_arrs:
-                    ref = ba.find(q0, namespaces=self.ns).get('ref')
-                    q = 'm:referenceableParamGroup[@id="' + ref + '"]'
-                    pg = pgr.find(q, namespaces=self.ns)
-                    q = './/m:cvParam[@accession="MS:1000514"]/..'
-                    if pg.find(q, namespaces=self.ns) is not None:
-                        x = self.read_binary(ba, pgr)
-                        break
-                    q = './/m:cvParam[@accession="MS:1000617"]/..'
-                    if pg.find(q, namespaces=self.ns) is not None:
-                        x = self.read_binary(ba, pgr)
-                        break
-                    q = './/m:cvParam[@accession="MS:1000786"]/..'
-                    if pg.find(q, namespaces=self.ns) is not None:
-                        x = self.read_binary(ba, pgr)
-                        break
-                else:
-                    continue
-
-            q = './/m:cvParam[@accession="MS:1000515"]/..'
-            y_elem = s.find(q, namespaces=self.ns)
-            if y_elem is not None:
-                y = self.read_binary(y_elem, pgr)
-            else:
-                # check paramGroupRef
-                q0 = './/m:referenceableParamGroupRef'
-                bin_arrs = s.findall(q0 + '/..', namespaces=self.ns)
-                for ba in bin_arrs:
-                    ref = ba.find(q0, namespaces=self.ns).get('ref')
-                    q = 'm:referenceableParamGroup[@id="' + ref + '"]'
-                    pg = pgr.find(q, namespaces=self.ns)
-                    q = './/m:cvParam[@accession="MS:1000515"]/..'
-                    if pg.find(q, namespaces=self.ns) is not None:
-                        y = self.read_binary(ba, pgr)
-                        break
-                else:
-                    continue
-
-            yield Scan(x, y, name=time)
-
-    def read_binary(self, ba, param_groups=None):
+            if scn.name < twin[0]:
+                continue
+            if scn.name > twin[1]:
+                break
+            yield scn
+
+    def spectrum(self, key):
+        """
+        Returns a single spectrum (as a Scan) by its position in
+        the file or by its id, e.g. 'scan=1234'.
+        """
+        s = self._elem_at('spectrum', key)
+        if s is None:
+            return None
+        return self._to_scan(s)
+
+    def read_binary(self, ba):
         """
         ba - binaryDataArray XML node
         """
         if ba is None:
             return []
 
-        pgr = ba.find('m:referenceableParamGroupRef', namespaces=self.ns)
-        if pgr is not None and param_groups is not None:
-            q = 'm:referenceableParamGroup[@id="' + pgr.get('ref') + '"]'
-            pg = param_groups.find(q, namespaces=self.ns)
-        else:
-            pg = ba
-
-        if pg.find('m:cvParam[@accession="MS:1000574"]',
-                   namespaces=self.ns) is not None:
-            compress = True
-        elif pg.find('m:cvParam[@accession="MS:1000576"]',
-                     namespaces=self.ns) is not None:
-            compress = False
-        else:
-            # TODO: no info? should check the other record?
-            pass
-
-        if pg.find('m:cvParam[@accession="MS:1000521"]',
-                   namespaces=self.ns) is not None:
-            dtype = 'f'
-        elif pg.find('m:cvParam[@accession="MS:1000523"]',
-                     namespaces=self.ns) is not None:
-            dtype = 'd'
-        else:
-            # TODO: no info? should check the other record?
-            pass
+        params = self._params(ba)
+        dtype = '<f8'
+        for acc, dt in [('MS:1000521', '<f4'), ('MS:1000523', '<f8'),
+                        ('MS:1000519', '<i4'), ('MS:1000522', '<i8')]:
+            if acc in params:
+                dtype = dt
+                break
 
         datatext = ba.find('m:binary', namespaces=self.ns).text
-        if compress:
-            rawdata = zlib.decompress(base64.b64decode(datatext))
-        else:
-            rawdata = base64.b64decode(datatext)
-        return np.fromstring(rawdata, dtype=dtype)
+        if datatext is None:
+            return np.array([], dtype=dtype)
+        rawdata = base64.b64decode(datatext)
+        if 'MS:1000574' in params:
+            rawdata = zlib.decompress(rawdata)
+        return np.frombuffer(rawdata, dtype=dtype)
 
     def total_trace(self, twin=None):
-        r = Et.parse(self.filename).getroot()
-
         # get it from the chromatogram list
-        c = r.find('.//m:cvParam[@accession="MS:1000235"]/..',
-                   namespaces=self.ns)
-        if c is not None:
-            q = './/m:cvParam[@accession="MS:1000595"]/..'
-            index = self.read_binary(c.find(q, namespaces=self.ns))
-            q = './/m:cvParam[@accession="MS:1000515"]/..'
-            values = self.read_binary(c.find(q, namespaces=self.ns))
-            return Trace(values, index, name='tic')
-
-        # # otherwise try to extract it from the individual records
-        # spectra = r.findall('*//m:spectrum/', namespaces=self.ns)
-        # for s in spectra:
-        #     # TIC
-        #     s.find('m:cvParam[@accession="MS:1000285"]', namespaces=self.ns)
-        #     # time
-        #     s.find('.//m:cvParam[@accession="MS:1000016"]', \
-        #            namespaces=self.ns)
-
-        # TODO: call parent function if no TIC found
+        idx = self._index
+        if idx is not None and 'chromatogram' in idx:
+            chroms = (self._elem_at('chromatogram', i)
+                      for i in range(len(idx['chromatogram'][0])))
+        else:
+            chroms = self._iterparse('chromatogram')
+
+        for c in chroms:
+            if c is None or 'MS:1000235' not in self._params(c):
+                continue
+            index, values = None, None
+            for ba in c.iterfind('m:binaryDataArrayList/m:binaryDataArray',
+                                 namespaces=self.ns):
+                accs = self._params(ba)
+                if 'MS:1000595' in accs:
+                    index = self.read_binary(ba)
+                elif 'MS:1000515' in accs:
+                    values = self.read_binary(ba)
+            if index is not None and values is not None:
+                return Trace(values, index, name='tic').twin(twin)
+
+        # otherwise calculate it from the individual spectra
+        return super(MzML, self).total_trace(twin)
 
 
 def write_mzxml(filename, df, info=None, precision='f'):
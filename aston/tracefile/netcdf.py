@@ -2,7 +2,7 @@ import numpy as np
 import scipy.sparse
 from scipy.io.netcdf import NetCDFFile
 from aston.trace.trace import Chromatogram, Trace
-from aston.tracefile import TraceFile
+from aston.tracefile import TraceFile, disk_cache
 
 
 class NetCDF(TraceFile):
@@ -10,35 +10,27 @@ class NetCDF(TraceFile):
     traces = ['#ms']
 
     def total_trace(self, twin=None):
-        f = NetCDFFile(open(self.filename, 'rb'))
-        tme = f.variables['scan_acquisition_time'].data / 60.
-        tic = f.variables['total_intensity'].data
-        return Trace(tic, tme, name='TIC')
+        # the file is memory-mapped, so only the scan
+        # variables get read off disk, not the point arrays
+        with NetCDFFile(self.filename, mmap=True) as f:
+            tme = f.variables['scan_acquisition_time'][:] / 60.
+            tic = f.variables['total_intensity'][:].astype(float)
+        return Trace(tic, tme, name='TIC').twin(twin)
 
     @property
+    @disk_cache
     def data(self):
-        f = NetCDFFile(open(self.filename, 'rb'))
-        t = f.variables['scan_acquisition_time'].data / 60.
-
-        # this is half the speed of the following code
-        # ions = list(set(f.variables['mass_values'].data))
-        # cols = np.array([ions.index(i) for i in \
-        #                  f.variables['mass_values'].data])
-
-        # TODO: slow; there has to be a way to vectorize this more?
-        ions = np.array(list(set(f.variables['mass_values'].data)))
-        rcols = f.variables['mass_values'].data
-        cols = np.empty(rcols.shape, dtype=int)
-        for i, ion in enumerate(ions):
-            cols[rcols == ion] = i
-
-        vals = f.variables['intensity_values'].data
-        rowst = np.add.accumulate(f.variables['point_count'].data)
-        rowst = np.insert(rowst, 0, 0)
+        with NetCDFFile(self.filename, mmap=True) as f:
+            t = f.variables['scan_acquisition_time'][:] / 60.
+            ions, cols = np.unique(f.variables['mass_values'][:],
+                                   return_inverse=True)
+            vals = f.variables['intensity_values'][:].astype(float)
+            rowst = np.zeros(len(t) + 1, dtype=int)
+            np.cumsum(f.variables['point_count'][:], out=rowst[1:])
 
         data = scipy.sparse.csr_matrix((vals, cols, rowst),
                                        shape=(len(t), len(ions)), dtype=float)
-        return Chromatogram(data.todense(), t, ions)
+        return Chromatogram(data, t, ions)
 
 
 def write_netcdf(filename, df, info=None):
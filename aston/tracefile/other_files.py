@@ -1,7 +1,7 @@
 import numpy as np
 # from pandas import read_csv
 from aston.trace import Chromatogram
-from aston.tracefile import TraceFile
+from aston.tracefile import TraceFile, disk_cache
 
 
 class CSVFile(TraceFile):
@@ -15,6 +15,7 @@ class CSVFile(TraceFile):
     # TODO: determine traces to list
 
     @property
+    @disk_cache
     def data(self):
         delim = ','
         try:  # TODO: better, smarter error checking than this
@@ -34,7 +35,11 @@ def write_csv(filename, df, info=None, delimiter=','):
         f.write('Time' + delimiter)
         f.write(delimiter.join(str(i) for i in df.data.columns.tolist()))
 
-        # write out the rest, scan by scan
+        # write out the rest, scan by scan; the scans might only
+        # have some of the columns in them (e.g. if they're sparse)
+        col_pos = {c: i for i, c in enumerate(df.data.columns.tolist())}
         for scan in df.scans():
+            row = np.zeros(len(col_pos))
+            row[[col_pos[x] for x in np.asarray(scan.x).tolist()]] = scan.abn
             f.write('\n ' + str(df.name) + delimiter)
-            f.write(delimiter.join(str(i) for i in scan.abn.tolist()))
+            f.write(delimiter.join(str(i) for i in row.tolist()))
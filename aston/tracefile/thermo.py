@@ -1,9 +1,9 @@
-import struct
-import re
+import mmap
 import os
+import struct
 import numpy as np
 from aston.trace import Chromatogram
-from aston.tracefile import TraceFile, find_offset
+from aston.tracefile import TraceFile, _map_file, disk_cache
 
 
 class ThermoCF(TraceFile):
@@ -11,31 +11,28 @@ class ThermoCF(TraceFile):
     traces = ['#irms']
 
     @property
+    @disk_cache
     def data(self):
-        f = open(self.filename, 'rb')
-        f.seek(19)
-        while True:
-            f.seek(f.tell() - 19)
-            if f.read(19) == b'CRawDataScanStorage':
-                break
-            if f.read(1) == b'':
-                f.close()
-                return
-
-        f.seek(f.tell() + 62)
-        nscans = struct.unpack('H', f.read(2))[0]
+        foff = _record_offsets(self, [b'CRawDataScanStorage'])
+        if foff.get(b'CRawDataScanStorage') is None:
+            return
 
         # TODO: this shouldn't be hardcoded
         ions = [44, 45, 46]
-        ni = len(ions)
 
-        f.seek(f.tell() + 35)
-        data = np.array([struct.unpack('<f' + ni * 'd', f.read(4 + ni * 8))
-                         for _ in range(nscans)])
-        data[:, 0] /= 60.  # convert time to minutes
-        # self.data = TimeSeries(data[:, 1:], data[:, 0], ions)
-        f.close()
-        return Chromatogram(data[:, 1:], data[:, 0], ions)
+        with open(self.filename, 'rb') as f:
+            f.seek(foff[b'CRawDataScanStorage'] + 62)
+            d = f.read(2)
+            if len(d) < 2:
+                # the file ends before the data does
+                return
+            nscans = struct.unpack('<H', d)[0]
+            f.seek(f.tell() + 35)
+            dtype = np.dtype([('index', '<f4'), ('values', '<f8', len(ions))])
+            data = np.fromfile(f, dtype=dtype, count=nscans)
+        # convert time to minutes
+        times = data['index'].astype(float) / 60.
+        return Chromatogram(data['values'], times, ions)
 
     @property
     def info(self):
@@ -49,20 +46,19 @@ class ThermoDXF(TraceFile):
     mime = 'application/vnd-thermo-dxf'
     traces = ['#irms', '*refgas']
 
+    # records in the file that data, info and events are read from
+    _records = [b'CRawData', b'CEvalGCData',
+                'd 18O/16O'.encode('utf_16_le'),
+                'd 13C/12C'.encode('utf_16_le'),
+                b'CActionHwTransferContainer']
+
     @property
+    @disk_cache
     def data(self):
+        foff = _record_offsets(self, self._records)
         f = open(self.filename, 'rb')
 
-        # TODO: use find_offset to find this?
-        # f.seek(11)
-        # while True:
-        #     f.seek(f.tell() - 11)
-        #     if f.read(11) == b'CEvalGCData':
-        #         break
-        #     if f.read(1) == b'':
-        #         f.close()
-        #         return
-        f.seek(find_offset(f, b'CRawData') + 9)
+        f.seek(foff[b'CRawData'] + 9)
         strlen = 2 * struct.unpack('<B', f.read(1))[0]
         tname = f.read(strlen).decode('utf_16_le')
         if tname == 'CO2':
@@ -76,7 +72,7 @@ class ThermoDXF(TraceFile):
             # TODO: should save the tname somewhere for future reference
             ions = [1, 2, 3]
 
-        f.seek(find_offset(f, b'CEvalGCData') + 4)
+        f.seek(foff[b'CEvalGCData'] + 4)
 
         # bytes until the end converted to # of records
         nscans = int(struct.unpack('<I', f.read(4))[0] /
@@ -98,9 +94,10 @@ class ThermoDXF(TraceFile):
         #     pass
         # info['file name'] = os.path.basename(self.filename)
         d['name'] = os.path.splitext(os.path.basename(self.filename))[0]
+        foff = _record_offsets(self, self._records)
+        foff_o = foff.get('d 18O/16O'.encode('utf_16_le'))
+        foff_c = foff.get('d 13C/12C'.encode('utf_16_le'))
         with open(self.filename, 'rb') as f:
-            foff_o = find_offset(f, 'd 18O/16O'.encode('utf_16_le'))
-            foff_c = find_offset(f, 'd 13C/12C'.encode('utf_16_le'))
             if foff_o is not None:
                 f.seek(foff_o + 68)
                 d['d18o_std'] = str(struct.unpack('<d', f.read(8))[0])
@@ -109,25 +106,6 @@ class ThermoDXF(TraceFile):
                 d['d13c_std'] = str(struct.unpack('<d', f.read(8))[0])
         return d
 
-    def _th_off(self, search_str, hint=None):
-        # TODO: replace all occurances with find_offset?
-        if hint is None:
-            hint = 0
-        with open(self.filename, 'rb') as f:
-            f.seek(hint)
-            regexp = re.compile(search_str.encode('ascii'))
-            while True:
-                d = f.read(len(search_str) * 200)
-                srch = regexp.search(d)
-                if srch is not None:
-                    foff = f.tell() - len(d) + srch.end()
-                    break
-                if len(d) == len(search_str):  # no data read: EOF
-                    f.close()
-                    return None
-                f.seek(f.tell() - len(search_str))
-        return foff
-
     def events(self, name='refgas', twin=None):
         # TODO: use twin
         # TODO: read in ref gas pulses
@@ -136,7 +114,8 @@ class ThermoDXF(TraceFile):
             return evts
 
         with open(self.filename, 'rb') as f:
-            f.seek(self._th_off('CActionHwTransferContainer'))
+            f.seek(_record_offsets(self, self._records)[
+                b'CActionHwTransferContainer'])
             evt, time, status = [], [], []
             while True:
                 d = struct.unpack('<ihHBB', f.read(10))
@@ -172,6 +151,29 @@ class ThermoDXF(TraceFile):
         return evts
 
 
+def _record_offsets(tf, records):
+    """
+    Finds where each of the named records in a Thermo file ends (i.e.
+    where its data starts), or None if it's not in the file.
+
+    The file is memory-mapped and searched once for all of them, and
+    the offsets are then kept on the TraceFile for next time.
+    """
+    offs = getattr(tf, '_rec_offs', None)
+    if offs is None:
+        offs = tf._rec_offs = {}
+    missing = [r for r in records if r not in offs]
+    if missing:
+        with open(tf.filename, 'rb') as f:
+            buf = _map_file(f)
+            for r in missing:
+                foff = buf.find(r)
+                offs[r] = None if foff == -1 else foff + len(r)
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+    return offs
+
+
 class ThermoRAW(TraceFile):
     mime = 'application/vnd-thermo-raw'
     traces = ['#ms']
@@ -1,8 +1,8 @@
-import struct
 import os.path as op
 import numpy as np
-from aston.trace import Chromatogram
-from aston.tracefile import TraceFile
+import scipy.sparse
+from aston.trace import Chromatogram, Trace
+from aston.tracefile import TraceFile, disk_cache
 
 
 class WatersAutospec(TraceFile):
@@ -11,61 +11,63 @@ class WatersAutospec(TraceFile):
     Will need to be extended to other Waters files?
     """
 
+    mime = 'application/vnd-waters-autospec'
     ext = 'IDX'
     traces = ['#ms']
 
-    # def _total_trace(self, twin=None):
-    #     fidx = open(self.filename, 'rb')
-    #     tme, tic = [], []
-    #     while True:
-    #         try:
-    #             d = struct.unpack('<IHHffhhh', fidx.read(22))
-    #             # I: offset in *.DAT file of data chunk
-    #             # H: number of data points in data chunk (bytes / 4)
-    #             # H:
-    #             # f: TIC of data point
-    #             # f: time of data point
-    #             # h:
-    #             # h: 10, 20, 21, 30, 31, 40, or 41?
-    #             # h: 80, A0, C0, E0
-    #         except struct.error:
-    #             break
-    #         tme.append(d[4])
-    #         tic.append(d[3])
-    #     fidx.close()
-    #     return TimeSeries(np.array(tic), np.array(tme), \
-    #                       ['TIC']).trace(twin=twin)
+    @property
+    def _idx(self):
+        """
+        Reads in all of the records in the *.IDX file.
+        """
+        with open(self.filename, 'rb') as f:
+            d = f.read()
+        return np.frombuffer(d, dtype=_IDX_DTYPE,
+                             count=len(d) // _IDX_DTYPE.itemsize)
+
+    def total_trace(self, twin=None):
+        idx = self._idx
+        return Trace(idx['tic'].astype(float), idx['time'].astype(float),
+                     name='TIC').twin(twin)
+
+    def _cache_deps(self):
+        return [op.splitext(self.filename)[0] + '.DAT']
 
     @property
+    @disk_cache
     def data(self):
-        fidx = open(self.filename, 'rb')
-        fdat = open(op.splitext(self.filename)[0] + '.DAT', 'rb')
+        idx = self._idx
+        dat = np.fromfile(op.splitext(self.filename)[0] + '.DAT', dtype='<u2')
+
+        # each point in a chunk is a pair of (abundance, ion) words
+        npts = idx['nbytes'].astype(int) // 4
+        rowst = np.zeros(len(idx) + 1, dtype=int)
+        rowst[1:] = np.cumsum(npts)
+        pt_off = np.arange(rowst[-1]) - np.repeat(rowst[:-1], npts)
+        pos = np.repeat(idx['offset'].astype(int) // 2, npts) + 2 * pt_off
+        vals, ions = dat[pos], dat[pos + 1]
+        rows = np.repeat(np.arange(len(idx)), npts)
+
+        cols, ion_idx = np.unique(ions, return_inverse=True)
+        # if an ion shows up twice in a scan, keep the last value read
+        # (by looking for the first occurrence in the reversed keys)
+        keys = (rows * len(cols) + ion_idx)[::-1]
+        _, last = np.unique(keys, return_index=True)
+        last = len(keys) - 1 - last
+        data = scipy.sparse.csr_matrix((vals[last].astype(float),
+                                        (rows[last], ion_idx[last])),
+                                       shape=(len(idx), len(cols)))
+        return Chromatogram(data, idx['time'].astype(float), cols.tolist())
 
-        ions = set([])
-        while True:
-            fdat.seek(fdat.tell() + 2)
-            try:
-                i = struct.unpack('<H', fdat.read(2))[0]
-            except struct.error:
-                break
-            ions.add(i)
-        ions = sorted(ions)
 
-        data = []
-        tme = []
-        while True:
-            try:
-                idx = struct.unpack('<IHHffhhh', fidx.read(22))
-                tme.append(idx[4])
-                fdat.seek(idx[0])
-                new_line = np.zeros(len(ions))
-                d = struct.unpack('<' + int(idx[1] / 4) * 'HH',
-                                  fdat.read(idx[1]))
-                for i, v in zip(d[1::2], d[0::2]):
-                    new_line[ions.index(i)] = v
-                data.append(new_line)
-            except struct.error:
-                break
-        fdat.close()
-        fidx.close()
-        return Chromatogram(np.array(data), np.array(tme), ions)
+# record in the *.IDX file for each scan
+_IDX_DTYPE = np.dtype([
+    ('offset', '<u4'),  # offset in *.DAT file of data chunk
+    ('nbytes', '<u2'),  # length of data chunk (four bytes per point)
+    ('unk1', '<u2'),
+    ('tic', '<f4'),  # TIC of scan
+    ('time', '<f4'),  # time of scan
+    ('unk2', '<i2'),
+    ('unk3', '<i2'),  # 10, 20, 21, 30, 31, 40, or 41?
+    ('unk4', '<i2'),  # 80, A0, C0, E0
+])